@@ -1,13 +1,24 @@
 #%% HCP analysis
 
+import sys
 import toblerone.utils 
 import scipy.io as sio 
 import matplotlib.pyplot as plt 
 import numpy as np 
 
+sys.path.append('..')
+from binned_stats import weighted_mean
+from figure_cache import Figure, build
+import reliability
+
 savekws = {'dpi': 400, 'bbox_inches': 'tight'}
 cmap = np.array(plt.get_cmap('Set1').colors)
 
+# Each figure is added to FIGURES, and built (or skipped, if unchanged since 
+# last time) in the last cell. Set REBUILD to redraw every figure regardless.
+FIGURES = []
+REBUILD = False
+
 #%% Load data
 
 data = sio.loadmat('HCP_data.mat')
@@ -27,27 +38,26 @@ sums *= (VOXSIZES ** 3)[None,:,None,None,None]
 ref = sums[:,0,:,0,:]
 sum_diffs = (100 * (sums[:,0,:,1,:] - ref) / ref)
 
-fig = plt.figure()
-fig.set_size_inches(7,4)
-ax = fig.add_subplot(1,1,1)
-ax.hold = True 
+def plot_sum_diffs(fig, sum_diffs):
+    fig.set_size_inches(7,4)
+    ax = fig.add_subplot(1,1,1)
 
-ax.plot([-2,8], [0,0], 'k-.', linewidth=0.5)
-g_violins = ax.violinplot(sum_diffs[:,:,0], positions=range(0,7,3)) 
-w_violins = ax.violinplot(sum_diffs[:,:-1,1], positions=range(1,6,3))
+    ax.plot([-2,8], [0,0], 'k-.', linewidth=0.5)
+    g_violins = ax.violinplot(sum_diffs[:,:,0], positions=range(0,7,3)) 
+    w_violins = ax.violinplot(sum_diffs[:,:-1,1], positions=range(1,6,3))
 
-(c1,c2) = ( v['bodies'][0]._facecolors for v in (g_violins, w_violins) )
-dh1 = ax.bar(8,1,color=c1)
-dh2 = ax.bar(9,1,color=c2)
+    (c1,c2) = ( v['bodies'][0]._facecolors for v in (g_violins, w_violins) )
+    dh1 = ax.bar(8,1,color=c1)
+    dh2 = ax.bar(9,1,color=c2)
 
-ax.set_xticks([0.5, 3.5, 6])
-ax.set_xticklabels(['Toblerone', 'FAST', 'RC \n(cortex only)'])
-ax.set_ylabel('Difference (%)')
-ax.set_xlim([-1, 7])
-ax.legend([dh1, dh2], ['GM', 'WM'], loc='lower right')
-ax.set_title('Difference (retest - test) in tissue volume')
+    ax.set_xticks([0.5, 3.5, 6])
+    ax.set_xticklabels(['Toblerone', 'FAST', 'RC \n(cortex only)'])
+    ax.set_ylabel('Difference (%)')
+    ax.set_xlim([-1, 7])
+    ax.legend([dh1, dh2], ['GM', 'WM'], loc='lower right')
+    ax.set_title('Difference (retest - test) in tissue volume')
 
-plt.savefig('figs/hcp_one_sum.png', **savekws)
+FIGURES.append(Figure('figs/hcp_one_sum.png', plot_sum_diffs, sum_diffs))
 
 
 #%% Difference between Tob and FAST PV estimates at each resolution 
@@ -55,30 +65,34 @@ plt.savefig('figs/hcp_one_sum.png', **savekws)
 # Not not all brains are the same size, and we want this test to be per-voxel
 # So reweight the 5% bins using the subject/session brain volume - this 
 # normalises out for brain volume so bigger brains with more voxels get more
-# weight 
+# weight. Empty bins (NaN) are left out of the average. 
 # sums is subs x voxels x method x sessions x tissue 
 weights = sums[:,0,0,:,0].mean(-1)
 weights = weights / weights.max()
-flat_means = np.average(vox_diffs.mean(2), axis=0, weights=weights)
+flat_means = weighted_mean(vox_diffs.mean(2), weights, axis=0)
 plot_bins = hist_bins[:-1] + 0.5*(hist_bins[1] - hist_bins[0])
 
-for tiss in range(2):
-    fig = plt.figure()
+def plot_vox_diffs(fig, plot_bins, means, tissue, voxsizes):
     fig.set_size_inches(7,5)
+    ax = fig.add_subplot(1,1,1)
 
-    for vidx,v in enumerate(VOXSIZES):
-        plt.plot(plot_bins, flat_means[vidx,tiss,:], 
+    for vidx,v in enumerate(voxsizes):
+        ax.plot(plot_bins, means[vidx,:], 
             label='%1.1fmm' % v, linewidth=1)
     
-    plt.plot(plot_bins, np.zeros_like(plot_bins), 'k--', linewidth=1)    
-    plt.xticks(plot_bins, labels=np.round(100*plot_bins,1), rotation=90)
-    plt.legend(ncol=3)
-    plt.xlabel('Toblerone GM PV (%)')
-    plt.ylabel('Mean difference (Toblerone - FAST)')
-    plt.title('Tob. - FAST %s PV difference, sorted by Tob. GM PV' % TISSUES[tiss])
-    plt.xlim(0,1)
+    ax.plot(plot_bins, np.zeros_like(plot_bins), 'k--', linewidth=1)    
+    ax.set_xticks(plot_bins)
+    ax.set_xticklabels(np.round(100*plot_bins,1), rotation=90)
+    ax.legend(ncol=3)
+    ax.set_xlabel('Toblerone GM PV (%)')
+    ax.set_ylabel('Mean difference (Toblerone - FAST)')
+    ax.set_title('Tob. - FAST %s PV difference, sorted by Tob. GM PV' % tissue)
+    ax.set_xlim(0,1)
 
-    plt.savefig('figs/hcp_vox_diffs_%s.png' % TISSUES[tiss], **savekws)
+for tiss in range(2):
+    FIGURES.append(Figure('figs/hcp_vox_diffs_%s.png' % TISSUES[tiss], 
+        plot_vox_diffs, plot_bins, flat_means[:,tiss,:], tissue=TISSUES[tiss], 
+        voxsizes=VOXSIZES))
 
 
 #%% Difference in struct vol wrt NU = 0, Noise = 0, 1mm iso. 
@@ -90,18 +104,65 @@ all_structs = toblerone.utils.STRUCTURES + ['Cortex']
 struct_ref = structs[:,0,:]
 struct_diffs = 100 * (structs[:,1,:] - struct_ref) / struct_ref
 
-fig = plt.figure()
-fig.set_size_inches(12, 18)
-zero_line = np.stack((np.zeros(len(all_structs)+2), np.arange(len(all_structs)+2)))
-plt.plot(zero_line[0,:], zero_line[1,:], 'k-.', linewidth=0.5)
-plt.violinplot(struct_diffs, vert=False)
-
-plt.yticks(range(1,len(all_structs)+1), labels=all_structs)
-plt.ylim(0.5, len(all_structs) + 0.5)
-plt.title('Difference (retest - test) in structure volume')
-plt.xlabel('Difference (%)')
-plt.ylabel('Structure')
-
-plt.savefig('figs/hcp_all_structs.png', **savekws)
+def plot_struct_diffs(fig, struct_diffs, all_structs):
+    fig.set_size_inches(12, 18)
+    ax = fig.add_subplot(1,1,1)
+    zero_line = np.stack((np.zeros(len(all_structs)+2), np.arange(len(all_structs)+2)))
+    ax.plot(zero_line[0,:], zero_line[1,:], 'k-.', linewidth=0.5)
+    ax.violinplot(struct_diffs, vert=False)
+
+    ax.set_yticks(range(1,len(all_structs)+1))
+    ax.set_yticklabels(all_structs)
+    ax.set_ylim(0.5, len(all_structs) + 0.5)
+    ax.set_title('Difference (retest - test) in structure volume')
+    ax.set_xlabel('Difference (%)')
+    ax.set_ylabel('Structure')
+
+FIGURES.append(Figure('figs/hcp_all_structs.png', plot_struct_diffs, 
+    struct_diffs, all_structs))
+
+
+#%% Test-retest reliability of tissue and structure volumes 
+# ICC, within-subject CV and Bland-Altman limits (as % of the mean), each with
+# a 95% bootstrap CI over subjects. Statistics for every voxel size, method 
+# and tissue (and every structure) are computed at once; sessions must be in 
+# the second dimension. The 0.7mm results are printed, and all are saved. 
+# Subjects with any missing (NaN) volume are left out, rather than entering
+# as zeros. The bootstrap runs in a process pool, so only under __main__.
+
+SEED = 0
+REPLICATES = 10000
+METHODS = ['Toblerone', 'FAST', 'RC']
+
+def complete_subjects(x, name):
+    keep = ~np.isnan(x.reshape(x.shape[0], -1)).any(-1)
+    if not keep.all(): 
+        print('%s: leaving out %d subjects with missing results' 
+            % (name, (~keep).sum()))
+    return x[keep]
+
+if __name__ == '__main__':
+    sum_rel, sum_ci = reliability.bootstrap(
+        np.moveaxis(complete_subjects(sums, 'sums'), 3, 1), 
+        replicates=REPLICATES, seed=SEED)
+    struct_rel, struct_ci = reliability.bootstrap(
+        complete_subjects(structs, 'structs'), 
+        replicates=REPLICATES, seed=SEED)
+
+    labels = [ '%s %s' % (m, t) for m in METHODS for t in TISSUES ]
+    print(reliability.table(sum_rel[:,0].reshape(-1, len(labels)), 
+        sum_ci[:,:,0].reshape(2, -1, len(labels)), labels))
+    print(reliability.table(struct_rel, struct_ci, all_structs))
+
+    sio.savemat('HCP_reliability.mat', { 'statistics': reliability.STATISTICS,
+        'sums': sum_rel, 'sums_ci': sum_ci, 'structs': struct_rel, 
+        'structs_ci': struct_ci, 'voxsizes': VOXSIZES, 'seed': SEED, 
+        'replicates': REPLICATES })
+
+
+#%% Render whichever figures have changed, in parallel
+
+if __name__ == '__main__':
+    build(FIGURES, savekws, force=REBUILD)
 
 #%%
@@ -0,0 +1,140 @@
+# Test-retest reliability statistics, for the HCP sums and structs arrays.
+# All functions take an array with subjects in the first dimension and the
+# (two) sessions in the second, and are vectorised over any further
+# dimensions (eg, voxel size x method x tissue, or structure), so that the
+# statistics for every combination are computed at once:
+#
+#   icc            intraclass correlation, ICC(A,1): two-way random effects,
+#                  absolute agreement, single measurement (McGraw & Wong)
+#   within_cv      within-subject coefficient of variation (%), root mean
+#                  square of each subject's SD / mean
+#   bland_altman   bias and 95% limits of agreement of the difference
+#                  (retest - test), as a percentage of each subject's mean
+#
+# bootstrap() gives percentile confidence intervals for all of these by
+# resampling subjects. Replicates are drawn in fixed-size blocks, each with
+# its own seed spawned from the given seed, and blocks are shared out over
+# a process pool; the result is therefore the same for any number of cores.
+
+import multiprocessing
+
+import numpy as np
+
+# Bootstrap replicates per block (the unit of work for each process)
+BLOCK = 250
+
+
+def icc(x):
+    """ICC(A,1) of x, sized (subjects, sessions, ...)"""
+
+    n, k = x.shape[0:2]
+    grand = x.mean((0, 1))
+    subs = x.mean(1)
+    sess = x.mean(0)
+    msr = k * np.sum((subs - grand) ** 2, axis=0) / (n - 1)
+    msc = n * np.sum((sess - grand) ** 2, axis=0) / (k - 1)
+    resid = x - subs[:,None] - sess[None,:] + grand
+    mse = np.sum(resid ** 2, axis=(0, 1)) / ((n - 1) * (k - 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n)
+
+
+def within_cv(x):
+    """Within-subject CV (%) of x, sized (subjects, sessions, ...)"""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cv2 = x.var(1, ddof=1) / (x.mean(1) ** 2)
+        return 100 * np.sqrt(cv2.mean(0))
+
+
+def bland_altman(x):
+    """
+    Bias and 95% limits of agreement of (retest - test) / mean, in %, for
+    x sized (subjects, 2, ...)
+
+    Returns:
+        array sized (3, ...): bias, lower limit, upper limit
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = 100 * (x[:,1] - x[:,0]) / x.mean(1)
+        bias = d.mean(0)
+        sd = d.std(0, ddof=1)
+    return np.stack((bias, bias - 1.96 * sd, bias + 1.96 * sd))
+
+
+# Names of the statistics returned by statistics(), in order
+STATISTICS = ['icc', 'cv', 'bias', 'loa_lower', 'loa_upper']
+
+
+def statistics(x):
+    """
+    All reliability statistics of x, sized (subjects, sessions, ...)
+
+    Returns:
+        array sized (len(STATISTICS), ...)
+    """
+
+    return np.concatenate((icc(x)[None], within_cv(x)[None], bland_altman(x)))
+
+
+def _boot_block(x, stat, seed, size):
+    # Stats for one block of replicates. Subject indices for every replicate
+    # are drawn at once, and the replicates placed (contiguously) in the last
+    # dimension, so each statistic reduces over all of them in one go
+    idx = np.random.default_rng(seed).integers(0, x.shape[0], (size, x.shape[0]))
+    return stat(np.ascontiguousarray(np.moveaxis(x[idx], 0, -1)))
+
+
+def bootstrap(x, stat=statistics, replicates=10000, seed=0, alpha=0.05, cores=None):
+    """
+    Percentile bootstrap confidence intervals, resampling subjects.
+
+    Args:
+        x: array sized (subjects, sessions, ...)
+        stat: vectorised statistic of such an array, eg icc. Must be
+            defined at module level (to be sent to the pool)
+        replicates: number of bootstrap replicates
+        seed: seed for the random number generator
+        alpha: intervals cover 1 - alpha
+        cores: number of processes (default all)
+
+    Returns:
+        (estimate, ci), where estimate is stat(x) and ci is sized
+        (2, *estimate.shape): the lower and upper bounds
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    sizes = [BLOCK] * (replicates // BLOCK)
+    if replicates % BLOCK:
+        sizes.append(replicates % BLOCK)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [ (x, stat, s, n) for s, n in zip(seeds, sizes) ]
+
+    cores = min(cores or multiprocessing.cpu_count(), len(jobs))
+    if cores <= 1:
+        blocks = [ _boot_block(*j) for j in jobs ]
+    else:
+        with multiprocessing.Pool(cores) as p:
+            blocks = p.starmap(_boot_block, jobs)
+
+    reps = np.concatenate(blocks, axis=-1)
+    ci = np.nanpercentile(reps, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=-1)
+    return stat(x), ci
+
+
+def table(estimate, ci, labels, names=STATISTICS):
+    """
+    Text table of statistics and their intervals, one row per label.
+    estimate and ci are as returned by bootstrap() for data sized
+    (subjects, sessions, labels), ie, sized (len(names), len(labels)) and
+    (2, len(names), len(labels)) respectively.
+    """
+
+    width = max(len(str(l)) for l in labels)
+    lines = [ ' ' * width + ''.join('%24s' % n for n in names) ]
+    for i, label in enumerate(labels):
+        cells = [ '%7.3f (%6.2f, %6.2f)' % (estimate[s,i], ci[0,s,i], ci[1,s,i])
+            for s in range(len(names)) ]
+        lines.append(('%-*s' % (width, label)) + ''.join('%24s' % c for c in cells))
+    return '\n'.join(lines)
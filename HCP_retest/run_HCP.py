@@ -1,6 +1,8 @@
 # HCP retest
 
 import os
+import sys
+import json
 import numpy as np 
 import os.path as op 
 import subprocess
@@ -13,15 +15,81 @@ import multiprocessing
 import nibabel
 import itertools
 import copy 
+import concurrent.futures
 import scipy.io as sio
-
-from image_scripts import do_RC, resample, masked_vox_diff, restack
+import time
+
+from image_scripts import do_RC, masked_vox_diff, resample, restack
+from binned_stats import binned_stats
+import nifti_cache
+from scheduler import Task, run_tasks
+from manifest import Manifest, tool_version, directory_inputs, file_hash
+import resampling
+import sparse_pv
+from refgrids import GridRegistry
+import telemetry
+from work_queue import WorkQueue, run_worker
+import rc_method
+from results_store import ResultsStore
+import tob_multires
+import surface_cache
+import cost_model
 
 T1ROOT = 'T1w_acpc_dc_restore_brain'
 VOXSIZES = np.hstack(([0.7], np.arange(1.0, 4.2, 0.4)))
 EXCLUDE = []
-
-ROOT = '/mnt/hgfs/Data/toblerone_evaluation_data/HCP_retest'
+RUNS = ['test', 'retest']
+METHODS = ['tob', 'fast', 'rc']
+HIST_BINS = np.arange(0, 1.05, 0.05)
+ALL_STRUCTS = STRUCTURES + ['cortex_GM']
+
+# Cores available to the whole pipeline, and used by each Toblerone task 
+CPU_BUDGET = os.cpu_count()
+TOB_CORES = 8
+
+# Share Toblerone's setup (surfaces, FIRST meshes) across all voxel sizes 
+# of a subject via tob_multires, rather than calling estimate_all for each. 
+# Only takes effect once 'run_HCP.py check-multires' has shown the two to
+# match for the installed toblerone; until then estimate_all is used 
+TOB_MULTIRES = False
+
+# RC estimation in Python (rc_method), rather than MATLAB/wb_command, and 
+# the cores used by each RC task. Only takes effect once 'run_HCP.py 
+# check-rc' has shown rc_method to match RCmethod.m on one subject and grid 
+# (for the current rc_method); until then, and by default, do_RC is used 
+RC_NATIVE = False
+RC_CORES = 4
+
+# Resample FAST in-process (resampling.resample_many, loading each subject's
+# map once) rather than with image_scripts.resample, which produced the 
+# published results. The two are different methods: check that they agree
+# with resampling.compare before switching. Each output records which was 
+# used, and is remade if this changes 
+FAST_RESAMPLE_IN_PROCESS = False
+
+# Write a sparse (.spv) copy of each PV map alongside the NIfTI, which the 
+# analysis then reads in preference. The NIfTI is still needed (by restack, 
+# the manifest and external tools), so this adds to disk use in exchange 
+# for faster analysis. Without it, pv_loader converts from the NIfTI 
+SPARSE_OUTPUTS = False
+
+# Record per-task timings, memory and IO of the subject pipeline, written 
+# out as a Chrome trace and summary table under ROOT/telemetry 
+TELEMETRY = True
+
+# Rough seconds per unit of work (see task_work) for each stage's tasks. 
+# These order tasks longest first until there is telemetry from past runs
+# to measure the rates 
+COST_PRIORS = { 'first_subject': 7.5e-4, 'fast_subject': 5e-4, 
+    'toblerone_subject': 1.3e-3, 'RC_subject': 2e-4 }
+
+# Features (see subject_features) of a typical HCP subject, for subjects 
+# whose features are not yet in the index 
+TYPICAL_FEATURES = { 'vertices': 5.6e5, 'brain': 1.2e6 }
+
+# May be overridden via the environment, eg for synthetic subjects (see 
+# synth_subjects.py)
+ROOT = os.environ.get('HCP_ROOT', '/mnt/hgfs/Data/toblerone_evaluation_data/HCP_retest')
 
 
 def SUBIDS():
@@ -36,6 +104,12 @@ def SUBIDS():
 def refname(v):
     return op.join(ROOT, 'refs', 'ref_%1.1f.nii.gz' % v)
 
+# Reference grids, matching those previously made with wb_command 
+# -volume-create (x is flipped). Images are written out by REFS.path(v) 
+# only for tools that need to read them
+REFS = GridRegistry(origin=[90, -126, -72], fov=np.array([260,311,260]) * 0.7, 
+    namer=refname, flip=(True, False, False), cache_dir=op.join(ROOT, 'refs', 'cache'))
+
 def subdir(ID):
     return op.join(ID, 'T1w')
 
@@ -47,7 +121,52 @@ def outdir(ID):
 def outname_formethod(outdir, method, vs):
     return op.join(outdir, '%s_%1.1f.nii.gz' % (method, vs))
 
-def map_over_subjects(run, nSubs, cores, func):
+def struct_index_path(od):
+    return op.join(od, 'struct_volumes.json')
+
+def update_struct_index(od):
+    """
+    Total PV of each Toblerone structure map at every voxel size, kept in a 
+    small sidecar JSON in the subject's processed dir. Entries are keyed by 
+    the size and mtime of their source image and recomputed only when that
+    changes. Returns the index as a dict of struct -> voxel size -> entry.
+    """
+
+    path = struct_index_path(od)
+    index = {}
+    if op.isfile(path):
+        with open(path, 'r') as f: 
+            index = json.load(f)
+
+    changed = False 
+    for struct in ALL_STRUCTS:
+        for v in VOXSIZES:
+            src = outname_formethod(od, 'tob_' + struct, v)
+            if not op.isfile(src):
+                continue 
+
+            st = os.stat(src)
+            key = '%1.1f' % v 
+            entry = index.get(struct, {}).get(key)
+            if (entry is not None and entry['size'] == st.st_size 
+                    and entry['mtime'] == st.st_mtime_ns):
+                continue 
+
+            img = nibabel.load(src).get_fdata(dtype=np.float32)
+            index.setdefault(struct, {})[key] = {
+                'total': float(img.sum(dtype=np.float64)), 
+                'size': st.st_size, 'mtime': st.st_mtime_ns }
+            changed = True 
+
+    if changed: 
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f: 
+            json.dump(index, f, indent=1)
+        os.replace(tmp, path)
+
+    return index 
+
+def subject_dirs(run, nSubs):
     subids = SUBIDS()
     subdirs = [ op.join(ROOT, run, d) for d in subids ]
     outdirs = [ op.join(d, 'T1w', 'processed') 
@@ -60,6 +179,136 @@ def map_over_subjects(run, nSubs, cores, func):
         if not op.isdir(d):
             os.mkdir(d)
 
+    return subdirs 
+
+def native_surfaces(ID):
+    id_n = op.split(ID)[1]
+    return [ op.join(subdir(ID), 'Native', '%s.%s.native.surf.gii' % (id_n, s)) 
+        for s in ('L.white', 'L.pial', 'R.white', 'R.pial') ]
+
+def subject_features(ID, index, compute=True):
+    """
+    Total vertices of the native surfaces (parsed via the surface cache, 
+    which RC then reuses) and brain volume (mm3) of the T1, 
+    cached in index. Features whose inputs are missing, or that are not in
+    the index when compute is False, are NaN.
+    """
+
+    surfs = native_surfaces(ID)
+    vertices = index.get('vertices', surfs)
+    if vertices is None: 
+        vertices = np.nan 
+        if compute and all( op.isfile(s) for s in surfs ):
+            vertices = sum( surface_cache.load(s)[0].shape[0] for s in surfs )
+            index.set('vertices', surfs, vertices)
+
+    t1 = op.join(subdir(ID), T1ROOT + '.nii.gz')
+    brain = index.get('brain', [t1])
+    if brain is None: 
+        brain = np.nan 
+        if compute and op.isfile(t1): 
+            img = nibabel.load(t1)
+            brain = (np.count_nonzero(np.asarray(img.dataobj)) 
+                * abs(np.linalg.det(img.affine[0:3,0:3])))
+            index.set('brain', [t1], brain)
+
+    return { 'vertices': vertices, 'brain': brain }
+
+def feature_index():
+    return cost_model.FeatureIndex(op.join(ROOT, 'cost_model', 'features.json'))
+
+def index_features(ID):
+    """
+    Add a subject's features to the index, for planning later runs. Called
+    after each subject's fast_subject (see traced_stage), rather than all 
+    at once when planning 
+    """
+
+    index = feature_index()
+    subject_features(ID, index)
+    index.save()
+
+class indexed(object):
+    """
+    A traced stage function, after which its subject's features are 
+    indexed. This happens outside of the stage's span, so that it is not 
+    counted in the time (and so the rate) measured for the stage
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.stage = func.stage
+        self.__name__ = func.__name__
+
+    def __call__(self, run, ID):
+        out = self.func(run, ID)
+        index_features(ID)
+        return out 
+
+def traced_stage(func):
+    """A per-subject stage function, traced, and indexed if fast_subject"""
+
+    func = telemetry.traced(func)
+    return indexed(func) if func.stage == 'fast_subject' else func
+
+def task_work(stage, features):
+    """
+    Amount of work in one subject's task for a stage. FIRST and FAST scale 
+    with brain volume. The surface methods scale with the number of voxels
+    the surfaces pass through, ie, their area (~ vertices) / v^2, summed 
+    over all voxel sizes. 
+    """
+
+    if stage in ('first_subject', 'fast_subject'):
+        return features['brain']
+    return features['vertices'] * np.sum(1 / VOXSIZES ** 2)
+
+def task_costs(calls):
+    """
+    Predicted seconds for each (stage, run, ID), with rates measured from 
+    the telemetry of all past runs. Features are only read from the index, 
+    never computed here (see index_features). A task whose work is not 
+    known takes the median of its stage or, if none is known (eg, on the 
+    first run), that of a typical subject. 
+    """
+
+    index = feature_index()
+    features = {}
+    def work(stage, ID):
+        if ID not in features: 
+            features[ID] = subject_features(ID, index, compute=False)
+        return task_work(stage, features[ID])
+
+    model = cost_model.CostModel(COST_PRIORS)
+    for stage, call, seconds in cost_model.history(op.join(ROOT, 'telemetry')):
+        if stage in COST_PRIORS and len(call) == 2 and op.isdir(call[1]):
+            model.observe(stage, work(stage, call[1]), seconds)
+
+    works = np.array([ work(stage, ID) for stage, run, ID in calls ], dtype=float)
+    for stage in { c[0] for c in calls }:
+        idx = np.array([ c[0] == stage for c in calls ])
+        missing = idx & np.isnan(works)
+        known = works[idx & ~missing]
+        works[missing] = (np.median(known) if known.size 
+            else task_work(stage, TYPICAL_FEATURES))
+
+    return [ model.predict(c[0], w) for c, w in zip(calls, works) ]
+
+def map_over_subjects(run, nSubs, cores, func):
+    """
+    Run func(run, subject) for each subject, longest predicted first, each
+    subject going to the next free worker 
+    """
+
+    subdirs = subject_dirs(run, nSubs)
+    costs = task_costs([ (func.__name__, run, sub) for sub in subdirs ])
+    plan = cost_model.longest_first([ Task(sub, func, cost=c) 
+        for sub, c in zip(subdirs, costs) ], costs)
+    subdirs = [ task.name for task in plan ]
+    print('%s %s: %d subjects, predicted makespan %1.0fs' % (func.__name__, run, 
+        len(subdirs), cost_model.makespan(plan, cores)))
+    func = traced_stage(func)
+
     if cores == 1:
         for sub in subdirs:
             func(run, sub)
@@ -67,30 +316,121 @@ def map_over_subjects(run, nSubs, cores, func):
     else: 
         f = functools.partial(func, run)
         with multiprocessing.Pool(cores) as p:
-            p.map(f, subdirs)
+            for _ in p.imap_unordered(f, subdirs):
+                pass 
+
+def pipeline_tasks(runs, nSubs):
+    """
+    Per-subject, per-stage tasks for all runs. Toblerone requires FIRST and 
+    FAST for the same subject and run; all else is independent. The order 
+    sets priority: FIRST and FAST go first to unblock Toblerone, and the 
+    RC tasks run while Toblerone waits on these, or once all of Toblerone 
+    has started (run_tasks does not backfill). Within each of these groups, 
+    tasks are ordered by their predicted cost, longest first. 
+    """
+
+    subs = [ (run, sub) for run in runs for sub in subject_dirs(run, nSubs) ]
+    name = lambda stage, run, sub: '%s:%s:%s' % (stage, run, op.split(sub)[1])
+
+    groups = [[], [], []]
+    for run, sub in subs: 
+        groups[0].append(Task(name('first', run, sub), traced_stage(first_subject), (run, sub)))
+        groups[0].append(Task(name('fast', run, sub), traced_stage(fast_subject), (run, sub)))
+    for run, sub in subs: 
+        groups[1].append(Task(name('toblerone', run, sub), traced_stage(toblerone_subject), 
+            (run, sub), cpus=TOB_CORES, 
+            deps=(name('first', run, sub), name('fast', run, sub))))
+    for run, sub in subs: 
+        groups[2].append(Task(name('RC', run, sub), traced_stage(RC_subject), (run, sub), 
+            cpus=(RC_CORES if rc_native() else 1)))
+
+    tasks = [ task for g in groups for task in g ]
+    costs = task_costs([ (task.func.stage,) + task.args for task in tasks ])
+    for task, c in zip(tasks, costs):
+        task.cost = c 
+    return [ task for g in groups for task in sorted(g, key=lambda task: -task.cost) ]
+
+def queue_dir():
+    return op.join(ROOT, 'queue')
+
+def fill_queue(runs, nSubs):
+    """
+    Add the pipeline's tasks to the work queue on the shared data directory. 
+    Tasks already queued are left as they are, so every node may do this. 
+    """
+
+    queue = WorkQueue(queue_dir())
+    qname = lambda name: name.replace(':', '.')
+    for idx, task in enumerate(pipeline_tasks(runs, nSubs)):
+        queue.add(qname(task.name), task.name.split(':')[0], task.args, 
+            task.cpus, [ qname(d) for d in task.deps ], priority=idx)
+    return queue
+
+def queue_worker(nSubs, budget=CPU_BUDGET):
+    """
+    Run the subject pipeline from the shared work queue, until it is 
+    finished, using this node's CPU budget. Start one of these on each node.
+    """
+
+    queue = fill_queue(RUNS, nSubs)
+    stages = { 'first': first_subject, 'fast': fast_subject, 
+        'toblerone': toblerone_subject, 'RC': RC_subject }
+    if TELEMETRY: 
+        telemetry.enable(op.join(ROOT, 'telemetry', 'queue'))
+    run_worker(queue, { k: traced_stage(f) for k, f in stages.items() }, budget)
+    queue_status()
+
+def queue_status():
+    for stage, counts in WorkQueue(queue_dir()).progress().items():
+        print('%-10s %s' % (stage, ', '.join('%s %d' % kv for kv in sorted(counts.items()))))
 
 def shell(cmd):
     subprocess.run(cmd, shell=True)
 
 def references():
-
-    t.utils._weak_mkdir(op.join(ROOT, 'refs'))
-    orig = np.array([90, -126, -72])
-    FoV = np.array([260,311,260]) * 0.7 
+    """Write out all reference images (not needed by the pipeline itself)"""
 
     for v in VOXSIZES: 
-        ref = refname(v)
-
-        if not op.isfile(ref):
-            dims = np.ceil(FoV / v)
-            cmd = 'wb_command -volume-create %d %d %d ' % (dims[0], dims[1], dims[2])
-            cmd += '%s -sform -%.3f 0 0 %.3f '  % (ref, v, orig[0])
-            cmd += '0 %.3f 0 %.3f ' % (v, orig[1])
-            cmd += '0 0 %.3f %.3f ' % (v, orig[2])
-
-            shell(cmd)
-
-
+        REFS.path(v)
+
+
+
+def fast_postprocess(sd, od, threads=3):
+    """
+    Stack FAST's GM and WM PVE maps with the implied CSF into one image, 
+    and mask this with the ribbon (whole brain, and cortex only). Everything
+    is done in memory and the outputs (fast_base, fast_base_brain and 
+    fast_base_cortex) are each written once, compressed on separate threads.
+    """
+
+    f1 = op.join(sd, T1ROOT + '_pve_1.nii.gz')
+    f2 = op.join(sd, T1ROOT + '_pve_2.nii.gz')
+    gmimg = nibabel.load(f1)
+    gm = gmimg.get_fdata(dtype=np.float32)
+    wm = nibabel.load(f2).get_fdata(dtype=np.float32)
+    base = np.stack((gm, wm, 1.0 - (gm + wm)), axis=-1)
+    del gm, wm 
+
+    # Brain mask is anywhere within the ribbon (as fslmaths -mas), cortex
+    # is the L/R cortical labels 
+    ribbon = nibabel.load(op.join(sd, 'ribbon.nii.gz')).get_fdata()
+    brainmask = (ribbon > 0)
+    ribbon = ribbon.round().astype(np.int32)
+    ctxmask = np.logical_or(ribbon == 3, ribbon == 42)
+
+    outputs = {
+        'fast_base': base, 
+        'fast_base_brain': base * brainmask[...,None], 
+        'fast_base_cortex': base * ctxmask[...,None],
+    }
+
+    def save(name):
+        nii = nibabel.Nifti1Image(outputs[name], gmimg.affine, gmimg.header)
+        nii.set_data_dtype(np.float32)
+        nibabel.save(nii, op.join(od, name + '.nii.gz'))
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(save, outputs))
 
 def fast_subject(run, ID):
 
@@ -99,48 +439,47 @@ def fast_subject(run, ID):
 
     base_brain = op.join(od, 'fast_base_brain.nii.gz')
     base_cortex = op.join(od, 'fast_base_cortex.nii.gz')
-
-    if not op.isfile(base_brain):
-
-        os.chdir(sd)
-        base = op.join(od, 'fast_base.nii.gz')
-
-        if not op.isfile(base):
-            cmd = 'fast -N %s' % (T1ROOT + '.nii.gz')
+    brainmaskf = op.join(sd, 'ribbon.nii.gz')
+    manifest = Manifest(od)
+    inputs = [ op.join(sd, T1ROOT + '.nii.gz'), brainmaskf ]
+    params = { 'tools': { 'fsl': tool_version('fsl') } }
+
+    if not manifest.is_current(base_brain, inputs, params):
+
+        # FAST writes its outputs alongside the input image 
+        t1 = op.join(sd, T1ROOT + '.nii.gz')
+        pve = op.join(sd, T1ROOT + '_pve_2.nii.gz')
+        if (not op.isfile(pve)) or (op.getmtime(pve) < op.getmtime(t1)):
+            cmd = 'fast -N %s' % t1
             shell(cmd)
 
-        # Merge the single channel images into one (in -t dim)
-        csffile = T1ROOT + "_pve_csf.nii.gz"
-        f1 = T1ROOT + "_pve_1" + ".nii.gz"
-        f2 = T1ROOT + "_pve_2" + ".nii.gz"
-        gm = nibabel.load(f1).get_fdata()
-        wm = nibabel.load(f2).get_fdata()
-        csf = 1.0 - (gm + wm)
-        t.classes.ImageSpace.save_like(f1, csf, csffile)
-        cmd = 'fslmerge -t %s %s %s %s' % (base, f1, f2, csffile)
-        shell(cmd)
-
-        # Mask using the ribbon 
-        base_brain = op.join(od, 'fast_base_brain.nii.gz')
-        brainmaskf = op.join(sd, 'ribbon.nii.gz')
-        brainmask = nibabel.load(brainmaskf).get_fdata().round().astype(np.int32)
-        ctxmask = np.logical_or(brainmask == 3, brainmask == 42)
-        ctxmaskf = op.join(od, 'cortex_mask.nii.gz')
-        t.classes.ImageSpace.save_like(base, ctxmask, ctxmaskf)
-        cmd = 'fslmaths %s -mas %s %s' % (base, ctxmaskf, base_cortex)
-        shell(cmd)
-        cmd = 'fslmaths %s -mas %s %s' % (base, brainmaskf, base_brain)
-        shell(cmd)
+        fast_postprocess(sd, od)
+        manifest.record(base_cortex, inputs, params)
+        manifest.record(base_brain, inputs, params)
+        write_sparse(base_brain)
 
+    # Resample onto each reference grid that has not been, with the current
+    # resampler (see FAST_RESAMPLE_IN_PROCESS)
+    resampler = 'resampling' if FAST_RESAMPLE_IN_PROCESS else 'image_scripts'
+    targets = []
     for v in VOXSIZES:
 
-        ref = refname(v)
+        grid = REFS.grid(v)
+        outname = outname_formethod(od, 'fast', v)
+        rparams = { 'vox': v, 'ref': grid.describe(), 'resampler': resampler }
 
-        for base, meth in zip([base_brain], ['fast']):
-            outname = outname_formethod(od, meth, v)
+        if (v != 0.7) and (not manifest.is_current(outname, [base_brain], rparams)):
+            targets.append((outname, v, rparams))
 
-            if (not op.isfile(outname)) and (v != 0.7):
-                resample(base, outname, ref)
+    if targets and FAST_RESAMPLE_IN_PROCESS: 
+        resampling.resample_many(base_brain, [ (o, REFS.grid(v)) for o, v, _ in targets ])
+    else: 
+        for outname, v, _ in targets: 
+            resample(base_brain, outname, REFS.path(v))
+
+    for outname, v, rparams in targets:
+        manifest.record(outname, [base_brain], rparams)
+        write_sparse(outname)
 
 
 
@@ -163,24 +502,129 @@ def toblerone_subject(run, ID):
 
     od = outdir(ID)
     t.utils._weak_mkdir(od)
+    manifest = Manifest(od)
+    inputs = ([ t1, RWS, RPS, LWS, LPS ] + directory_inputs(first, '*_first.vtk')
+        + directory_inputs(sd, T1ROOT + '_pve_[0-9].nii.gz'))
+
+    tob_args = dict(LWS=LWS, LPS=LPS, RWS=RWS, RPS=RPS, fastdir=sd, 
+        firstdir=first, struct=t1)
 
+    # Grids for which a stacked map cannot be made from existing outputs. 
+    # These are only restacked if every one of them is current with respect
+    # to the same inputs and params (otherwise they would be stale)
+    todo = []
     for v in VOXSIZES: 
 
         tobfile = od + '/tob_all_stacked_%1.1f.nii.gz' % v
-        ref = refname(v)
-        spc = t.classes.ImageSpace(ref)
+        ref = REFS.path(v)
+        spc = REFS.space(v)
+        params = { 'vox': v, 'ref': ref, 'tools': { 'toblerone': tool_version('toblerone') } }
 
-        if not op.isfile(tobfile):
+        if not manifest.is_current(tobfile, inputs + [ref], params):
+            parts = tob_outputs(od, v)
             try: 
+                if not (parts and all( manifest.is_current(p, inputs + [ref], params) 
+                        for p in parts )):
+                    raise RuntimeError("Toblerone outputs are missing or out of date")
                 stacked = restack(od, '_%1.1f' % v)
                 spc.save_image(stacked, tobfile)
+                manifest.record(tobfile, inputs + [ref], params)
+                write_sparse(tobfile)
 
             except Exception as e: 
-                pvs, _ = t.estimate_all(LWS=LWS, LPS=LPS, RWS=RWS, RPS=RPS, 
-                    ref=ref, struct2ref='I', fastdir=sd, firstdir=first, struct=t1, cores=8)
-                for key,img in pvs.items():
-                    outpath = outname_formethod(od, 'tob_' + key, v)
-                    spc.save_image(img, outpath) 
+                todo.append((v, tobfile, ref, spc, params))
+
+    # Estimate on all remaining grids. If the multi-resolution path has been
+    # checked, the surfaces and FIRST meshes are loaded only once 
+    setup = None 
+    if todo and TOB_MULTIRES and multires_checked(): 
+        with telemetry.span('toblerone setup %s' % id_n, stage='toblerone_setup'):
+            setup = tob_multires.SubjectSetup(**tob_args)
+
+    for v, tobfile, ref, spc, params in todo: 
+        with telemetry.span('toblerone %s %1.1f' % (id_n, v), 
+                stage='toblerone_vox', vox=v):
+            if setup is not None: 
+                pvs = tob_multires.estimate_grid(setup, ref, TOB_CORES)
+            else: 
+                pvs = estimate_all(ref, **tob_args)
+            for key,img in pvs.items():
+                outpath = outname_formethod(od, 'tob_' + key, v)
+                spc.save_image(img, outpath) 
+                manifest.record(outpath, inputs + [ref], params)
+            spc.save_image(pvs['stacked'], tobfile)
+
+        manifest.record(tobfile, inputs + [ref], params)
+        write_sparse(tobfile)
+
+    update_struct_index(od)
+
+def tob_outputs(od, v):
+    """Toblerone's individual output maps on one grid (not the stacked map)"""
+
+    return [ p for p in directory_inputs(od, 'tob_*_%1.1f.nii.gz' % v) 
+        if not op.basename(p).startswith('tob_all_stacked') ]
+
+def estimate_all(ref, **tob_args):
+    pvs, _ = t.estimate_all(ref=ref, struct2ref='I', cores=TOB_CORES, **tob_args)
+    return pvs 
+
+def check_path(name):
+    return op.join(ROOT, 'checks', name + '.json')
+
+def read_check(name):
+    """Record of the last check of an alternative method, if any"""
+
+    try: 
+        with open(check_path(name), 'r') as f: 
+            return json.load(f)
+    except (FileNotFoundError, ValueError): 
+        return None 
+
+def write_check(name, record):
+    path = check_path(name)
+    os.makedirs(op.dirname(path), exist_ok=True)
+    tmp = path + '.%d.tmp' % os.getpid()
+    with open(tmp, 'w') as f: 
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def multires_checked():
+    """Has tob_multires been checked against the installed toblerone?"""
+
+    record = read_check('tob_multires')
+    return (record is not None and record['passed'] 
+        and (record['toblerone'] == tool_version('toblerone')))
+
+def check_multires(ID, v=2.2):
+    """
+    Run tob_multires and estimate_all for one subject (the path to their
+    test session) on one grid, and record whether every output matches. 
+    toblerone_subject only uses tob_multires once this has passed.
+    """
+
+    id_n = op.split(ID)[1]
+    sd = subdir(ID)
+    tob_args = dict(fastdir=sd, firstdir=op.join(sd, 'processed', 'first'),
+        struct=op.join(sd, T1ROOT + '.nii.gz'))
+    for side in 'LR': 
+        for surf, key in [('white', 'WS'), ('pial', 'PS')]:
+            tob_args[side + key] = op.join(sd, 'Native', 
+                '%s.%s.%s.native.surf.gii' % (id_n, side, surf))
+
+    ref = REFS.path(v)
+    setup = tob_multires.SubjectSetup(**tob_args)
+    passed, diffs = tob_multires.check(
+        tob_multires.estimate_grid(setup, ref, TOB_CORES), estimate_all(ref, **tob_args))
+
+    write_check('tob_multires', { 'passed': passed, 
+        'toblerone': tool_version('toblerone'), 'subject': id_n, 'vox': v, 
+        'atol': tob_multires.CHECK_ATOL, 'max_abs_diff': diffs })
+
+    for key in sorted(diffs): 
+        print('%-16s %g' % (key, diffs[key]))
+    print('tob_multires %s estimate_all' % ('matches' if passed else 'DOES NOT match'))
+    return passed 
 
 
 def first_subject(run, ID):
@@ -188,10 +632,18 @@ def first_subject(run, ID):
     od = outdir(ID)
     fd = op.join(od, 'first')
     t1 = op.join(subdir(ID), 'T1w_acpc_dc_restore.nii.gz')
-    if not op.isfile(op.join(fd, 'T1w_acpc_dc_restore' + '-BrStem_first.vtk')):
+    check = op.join(fd, 'T1w_acpc_dc_restore' + '-BrStem_first.vtk')
+    manifest = Manifest(od)
+    params = { 'tools': { 'fsl': tool_version('fsl') } }
+    if not manifest.is_current(check, [t1], params):
         t.utils._runFIRST(t1, fd)
+        manifest.record(check, [t1], params)
 
-def loader(run, sub, method, vox, silent):
+def write_sparse(path):
+    if SPARSE_OUTPUTS: 
+        sparse_pv.convert(path, sparse_pv.sparse_name(path))
+
+def pv_path(run, sub, method, vox):
 
     s = op.join(ROOT, run, sub, 'T1w/processed')
 
@@ -205,120 +657,294 @@ def loader(run, sub, method, vox, silent):
     else:
         fname = '%s_%1.1f' % (method, vox)
 
-    s = op.join(s, '%s.nii.gz' % (fname))
+    return op.join(s, '%s.nii.gz' % (fname))
+
+def pv_loader(run, sub, method, vox):
+    """
+    PV map in sparse form: read from the .spv copy if there is an up to 
+    date one, otherwise converted from the NIfTI
+    """
+
+    path = pv_path(run, sub, method, vox)
+    spv = sparse_pv.sparse_name(path)
+    if op.isdir(spv) and (op.getmtime(spv) >= op.getmtime(path)):
+        return sparse_pv.load(spv)
+
+    affine = nibabel.load(path).affine
+    return sparse_pv.SparsePV.from_dense(nifti_cache.load(path), affine)
+
+def results_store():
+    """
+    Store of per-subject analysis results, written as each is computed and 
+    exported to HCP_data.mat once all are done 
+    """
+
+    store = ResultsStore(op.join(ROOT, 'results'))
+    store.define('sums', ('subject', 'vox'), ('method', 'run', 'tissue'), 
+        { 'method': METHODS, 'run': RUNS, 'tissue': ['GM', 'WM'] })
+    store.define('diffs', ('subject', 'vox'), ('run', 'tissue', 'bin'), 
+        { 'run': RUNS, 'tissue': ['GM', 'WM'], 'bin': range(HIST_BINS.size - 1) })
+    store.define('structs', ('subject',), ('run', 'struct'), 
+        { 'run': RUNS, 'struct': ALL_STRUCTS })
+    return store 
+
+def unit_inputs(sub, vox):
+    return [ pv_path(run, sub, method, vox) for run in RUNS for method in METHODS ]
+
+def struct_inputs(sub):
+    return [ outname_formethod(op.join(ROOT, run, sub, 'T1w', 'processed'), 
+        'tob_' + struct, 0.7) for run in RUNS for struct in ALL_STRUCTS ]
+
+def unit_is_current(store, sub, vidx):
+    vox = VOXSIZES[vidx]
+    current = all( store.is_current(name, (sub, vox), unit_inputs(sub, vox)) 
+        for name in ('sums', 'diffs') )
+    if vidx == 0: 
+        current = current and store.is_current('structs', sub, struct_inputs(sub))
+    return current 
+
+def analyse_unit(subs, unit):
+    """
+    Reduce all volumes for one subject at one voxel size, and write the 
+    results to the store. Each volume is loaded once and discarded as soon 
+    as it has been used, so at most two are held in memory at any time. The
+    structure volumes do not depend on voxel size and are computed for the 
+    first voxel size only. 
+    """
+
+    sidx, vidx = unit 
+    sub = subs[sidx]
+    vox = VOXSIZES[vidx]
+    store = results_store()
+
+    # Dims: methods x runs x tissues, and runs x tissues x bins 
+    sums = np.zeros((len(METHODS), len(RUNS), 2), dtype=np.float32)
+    diffs = np.zeros((len(RUNS), 2, HIST_BINS.size - 1), dtype=np.float32)
+    structs = None 
+
+    for ridx,run in enumerate(RUNS):
+        tob = pv_loader(run, sub, 'tob', vox)
+        fast = pv_loader(run, sub, 'fast', vox)
+        sums[0,ridx,:] = tob.sum()[0:2]
+        sums[1,ridx,:] = fast.sum()[0:2]
+
+        # Mean Tob - FAST difference, binned by Toblerone's GM PV. Voxels 
+        # with GM > 0 are all stored explicitly (the fill has no GM), so 
+        # only these need to be read from FAST 
+        if tob.fill[0] != 0: 
+            raise RuntimeError("Toblerone PV map has non-zero GM fill")
+        tvals = tob.values
+        mask = (tvals[:,0] > 0)
+        fvals = fast.take(tob.indices[mask])
+        d = (tvals[mask,0:2] - fvals[:,0:2])
+        diffs[ridx,...] = binned_stats(tvals[mask,0], d, HIST_BINS)['mean'].T
+        del tob, fast, tvals, fvals, d 
+
+        sums[2,ridx,:] = pv_loader(run, sub, 'rc', vox).sum()[0:2]
+
+    # Tissue volume of each subcortical structure (Toblerone only), read
+    # from the structure index (which is brought up to date if need be).
+    # Structures whose map is missing are NaN
+    if vidx == 0:
+        structs = np.zeros((len(RUNS), len(ALL_STRUCTS)), dtype=np.float32)
+        for midx,meth in enumerate(RUNS):
+            index = update_struct_index(op.join(ROOT, meth, sub, 'T1w', 'processed'))
+            for stridx,struct in enumerate(ALL_STRUCTS):
+                entry = index.get(struct, {}).get('0.7')
+                structs[midx,stridx] = np.nan if entry is None else entry['total']
+        store.write('structs', sub, structs, struct_inputs(sub))
+
+    store.write('diffs', (sub, vox), diffs, unit_inputs(sub, vox))
+    store.write('sums', (sub, vox), sums, unit_inputs(sub, vox))
+    return unit 
+
+def analyse(nSubs, cores):
+    """
+    Reduce the outputs of all methods into the arrays saved in HCP_data.mat.
+    Subject/voxel size units are sharded across a pool of processes, which 
+    write their results to the store; units whose results are already there
+    (and whose inputs have not changed since) are skipped. 
+    """
+
+    # Matrix is sized: subs x vox x methods x runs x tissues
+    subs = SUBIDS()[0:nSubs]
+    store = results_store()
+    units = [ (sidx, vidx) for sidx, vidx in 
+        itertools.product(range(len(subs)), range(len(VOXSIZES)))
+        if not unit_is_current(store, subs[sidx], vidx) ]
+    f = functools.partial(analyse_unit, subs)
 
-    try: 
-        return nibabel.load(s).get_fdata().reshape(-1,3)
-    except Exception as e: 
-        if silent: 
-            refsize = nibabel.load(refname(vox)).header['dim'][1:4]
-            return np.zeros((np.prod(refsize), 3))
-        else:
-            raise e 
+    if cores == 1:
+        list(map(f, units))
+    else: 
+        with multiprocessing.Pool(cores) as p:
+            list(p.imap_unordered(f, units))
 
+    return export_results(store, subs)
 
-def RC_subject(run, ID): 
+def export_results(store, subs):
+    """
+    Arrays in the layout of HCP_data.mat. Every subject must have results at 
+    every voxel size: a missing unit would otherwise enter the analysis as 
+    a subject with zero volume.
+    """
 
-    id_n = op.split(ID)[1]
+    missing = [ '%s %1.1f' % (sub, v) for sub in subs for v in VOXSIZES 
+        if any( store.read(n, (sub, v)) is None for n in ('sums', 'diffs') ) ]
+    missing += [ sub for sub in subs if store.read('structs', sub) is None ]
+    if missing: 
+        raise RuntimeError("No results for %d units: %s" % (len(missing), missing))
 
-    od = outdir(ID)
+    sums = store.gather('sums', [subs, VOXSIZES], fill=np.nan)
+    diffs = store.gather('diffs', [subs, VOXSIZES], fill=np.nan)
+    structs = store.gather('structs', [subs], fill=np.nan)
+    voxs = np.zeros((len(subs), len(VOXSIZES), len(METHODS), 2, 2), dtype=np.float32)
+
+    return {
+        'sums': sums, 'voxs': voxs, 'diffs': diffs, 'hist_bins': HIST_BINS, 'structs': structs
+        }
+
+def rc_surfaces(ID):
+    """Native white, pial and mid surfaces, as keyword arguments for do_RC"""
+
+    id_n = op.split(ID)[1]
     surfdir = op.join(subdir(ID), 'Native')
     space = 'native'
+    return { side + key: op.join(surfdir, '%s.%s.%s.%s.surf.gii' % (id_n, side, surf, space))
+        for side in 'LR' for surf, key in [('white', 'WS'), ('pial', 'PS'), ('mid', 'MS')] }
+
+def rc_native():
+    """
+    Is RC estimated by rc_method? Only if RC_NATIVE is set and check_rc has
+    passed for the current rc_method
+    """
+
+    if not RC_NATIVE: 
+        return False 
+    record = read_check('rc_method')
+    return (record is not None and record['passed'] 
+        and (record['rc_method'] == file_hash(rc_method.__file__)))
+
+def check_rc(ID, v=2.2):
+    """
+    Estimate RC for one subject (the path to their test session) on one grid
+    with both rc_method and do_RC (RCmethod.m), and record whether they 
+    match to within rc_method's tolerances. RC_subject only uses rc_method
+    once this has passed.
+    """
+
+    id_n = op.split(ID)[1]
+    surfs = rc_surfaces(ID)
+    grid = REFS.grid(v)
+    hemis = [ rc_method.load_hemisphere(surfs[h + 'WS'], surfs[h + 'PS'], surfs[h + 'MS'])
+        for h in 'LR' ]
+    ours = rc_method.estimate(hemis, grid.affine, grid.shape, RC_CORES)
+
+    outname = op.join(op.dirname(check_path('rc_method')), 'RC_%s_%1.1f.nii.gz' % (id_n, v))
+    os.makedirs(op.dirname(outname), exist_ok=True)
+    do_RC(outname=outname, vox=v, ref=REFS.path(v), **surfs)
+    reference = nibabel.load(outname).get_fdata(dtype=np.float32)
+    passed, diffs = rc_method.check(ours, reference)
+
+    write_check('rc_method', { 'passed': passed, 'rc_method': file_hash(rc_method.__file__),
+        'wb_command': tool_version('wb_command'), 'subject': id_n, 'vox': v, 
+        'mean_atol': rc_method.CHECK_MEAN_ATOL, 'total_pct': rc_method.CHECK_TOTAL_PCT,
+        'diffs': diffs })
+
+    for tissue, d in diffs.items(): 
+        print('%-4s max %.4f  mean %.4f  total %+.2f%%' % (tissue, d['max'], d['mean'], d['total_pct']))
+    print('rc_method %s RCmethod.m' % ('matches' if passed else 'DOES NOT match'))
+    return passed 
 
-    RWS = op.join(surfdir, '%s.R.white.%s.surf.gii' % (id_n,space)) 
-    RPS = op.join(surfdir, '%s.R.pial.%s.surf.gii' % (id_n,space)) 
-    LWS = op.join(surfdir, '%s.L.white.%s.surf.gii' % (id_n,space)) 
-    LPS = op.join(surfdir, '%s.L.pial.%s.surf.gii' % (id_n,space)) 
-    RMS = op.join(surfdir, '%s.R.mid.%s.surf.gii' % (id_n,space)) 
-    LMS = op.join(surfdir, '%s.L.mid.%s.surf.gii' % (id_n,space)) 
+def RC_subject(run, ID): 
+
+    id_n = op.split(ID)[1]
+    od = outdir(ID)
+    surfs = rc_surfaces(ID)
+    LWS, LPS, LMS = surfs['LWS'], surfs['LPS'], surfs['LMS']
+    RWS, RPS, RMS = surfs['RWS'], surfs['RPS'], surfs['RMS']
+    native = rc_native()
+
+    manifest = Manifest(od)
+    inputs = [ LWS, LPS, RWS, RPS ]
+    hemis = None 
+
+    # The mid surfaces are used where they exist (rc_method otherwise makes 
+    # its own, see rc_method.mid_surface) 
+    mids = [ ms for ms in [LMS, RMS] if op.isfile(ms) ]
 
     for v in VOXSIZES:
         outname = outname_formethod(od, 'RC', v)
 
-        if not op.isfile(outname):
-            ref = refname(v)
-            PVs = do_RC(LPS=LPS, RPS=RPS, LWS=LWS, RWS=RWS, RMS=RMS, LMS=LMS, outname=outname, vox=v, ref=ref)
+        if native: 
+            grid = REFS.grid(v)
+            params = { 'method': 'rc_method', 'vox': v, 'ref': grid.describe() }
+            if manifest.is_current(outname, inputs + mids, params):
+                continue 
+
+            # Surfaces are loaded once and shared by all voxel sizes 
+            if hemis is None: 
+                hemis = [ rc_method.load_hemisphere(ws, ps, ms)
+                    for ws, ps, ms in [(LWS, LPS, LMS), (RWS, RPS, RMS)] ]
+
+            with telemetry.span('RC %s %1.1f' % (id_n, v), stage='RC_vox', vox=v):
+                PVs = rc_method.estimate(hemis, grid.affine, grid.shape, RC_CORES)
+                REFS.space(v).save_image(PVs, outname)
+            manifest.record(outname, inputs + mids, params)
+            write_sparse(outname)
+
+        else: 
+            ref = REFS.path(v)
+            params = { 'tools': { 'wb_command': tool_version('wb_command') }, 'vox': v }
+            if not manifest.is_current(outname, inputs + [ref], params):
+                with telemetry.span('RC %s %1.1f' % (id_n, v), stage='RC_vox', vox=v):
+                    PVs = do_RC(LPS=LPS, RPS=RPS, LWS=LWS, RWS=RWS, RMS=RMS, LMS=LMS, outname=outname, vox=v, ref=ref)
+                manifest.record(outname, inputs + [ref], params)
+                write_sparse(outname)
 
 
 def main(root): 
 
     root = ROOT
 
-    print("Producing references")
-    references()
-
     cores = 8
     nSubs = 45
 
     if True: 
-    
-        runs = ['test', 'retest']
-
-        for run in runs: 
-
-            print("First", run)
-            map_over_subjects(run, nSubs, cores, first_subject)
-                
-            print("RC", run)
-            map_over_subjects(run, nSubs, 1, RC_subject)
 
-            print("FAST", run)
-            map_over_subjects(run, nSubs, cores, fast_subject)
-
-            print("Toblerone", run)
-            map_over_subjects(run, nSubs, 3, toblerone_subject)
+        # First, RC, FAST and Toblerone for test and retest together
+        print("Subject pipeline")
+        if TELEMETRY: 
+            tdir = op.join(ROOT, 'telemetry', time.strftime('%Y%m%d_%H%M%S'))
+            telemetry.enable(tdir)
+
+        try: 
+            tasks = pipeline_tasks(RUNS, nSubs)
+            print("Predicted makespan: %1.1f h" % (cost_model.makespan(tasks, CPU_BUDGET) / 3600))
+            run_tasks(tasks, CPU_BUDGET)
+        finally: 
+            if TELEMETRY: 
+                telemetry.chrome_trace(tdir, op.join(tdir, 'trace.json'))
+                print(telemetry.summary(tdir))
 
     if True: 
         print("Analysis")
-
-        # Matrix is sized: subs x vox x methods x runs x tissues
-        methods = ['tob', 'fast', 'rc']
-        subs = SUBIDS()[0:nSubs]
-        sums = np.zeros((nSubs, len(VOXSIZES), len(methods), 2, 2), dtype=np.float32)
-        voxs = np.zeros((nSubs, len(VOXSIZES), len(methods), 2, 2), dtype=np.float32)
-        hist_bins = np.arange(0, 1.05, 0.05)
-        diffs = np.zeros((nSubs, len(VOXSIZES), 2, 2, hist_bins.size -1), dtype=np.float32)
-        all_structs = STRUCTURES + ['cortex_GM']
-        structs = np.zeros((nSubs, 2, len(all_structs)), dtype=np.float32)
-
-        summer = lambda a: np.sum(a[:,0:2], axis=0)
-    
-        for (sidx,sub) in enumerate(subs):        
-            for (vidx,vox) in enumerate(VOXSIZES): 
-                silent = False 
-                tob, fast, rc = [ loader('test', sub, m, vox, silent) for m in methods ]
-                tob2, fast2, rc2 = [ loader('retest', sub, m, vox, silent) for m in methods ]
-
-                sums[sidx,vidx,0,0,:] = summer(tob)
-                sums[sidx,vidx,1,0,:] = summer(fast)
-                sums[sidx,vidx,2,0,:] = summer(rc)
-                sums[sidx,vidx,0,1,:] = summer(tob2)
-                sums[sidx,vidx,1,1,:] = summer(fast2)
-                sums[sidx,vidx,2,1,:] = summer(rc2)
-
-                mask = (tob[:,0] > 0)
-                mask2 = (tob2[:,0] > 0)
-                inds = np.digitize(tob[mask,0], hist_bins)
-                inds2 = np.digitize(tob2[mask2,0], hist_bins)  
-                d = (tob[mask,:] - fast[mask,:])
-                d2 = (tob2[mask2,:] - fast2[mask2,:])
-
-                for tiss in range(2):
-                    for b in range(hist_bins.size - 1):
-                        diffs[sidx,vidx,0,tiss,b] = np.mean(d[inds == b+1,tiss])
-                        diffs[sidx,vidx,1,tiss,b] = np.mean(d2[inds2 == b+1,tiss])
-
-                # Tissue volume of each subcortical structure (Toblerone only)
-                for stridx,struct in enumerate(all_structs):
-                    for midx,meth in enumerate(['test', 'retest']):
-                        tob_str = nibabel.load(op.join(ROOT, meth, sub, 'T1w', 'processed', 'tob_%s_0.7.nii.gz' % struct)).get_fdata()
-                        structs[sidx,midx,stridx] = tob_str.sum()
-
-
-        sio.savemat('HCP_data.mat', {
-            'sums': sums, 'voxs': voxs, 'diffs': diffs, 'hist_bins': hist_bins, 'structs': structs
-            })
+        data = analyse(nSubs, cores)
+        sio.savemat('HCP_data.mat', data)
 
 if __name__ == "__main__":
-    
-    main(ROOT)
\ No newline at end of file
+
+    # Multi-node mode: run 'run_HCP.py worker' on each node (sharing ROOT), 
+    # and 'run_HCP.py status' to see progress. 'run_HCP.py check-multires 
+    # [subject]' checks tob_multires before it is used (see TOB_MULTIRES), 
+    # and 'run_HCP.py check-rc [subject]' likewise rc_method (see RC_NATIVE)
+    if sys.argv[1:2] == ['worker']:
+        queue_worker(nSubs=45)
+    elif sys.argv[1:2] == ['status']:
+        queue_status()
+    elif sys.argv[1:2] == ['check-multires']:
+        check_multires(op.join(ROOT, 'test', (sys.argv[2:3] or SUBIDS())[0]))
+    elif sys.argv[1:2] == ['check-rc']:
+        check_rc(op.join(ROOT, 'test', (sys.argv[2:3] or SUBIDS())[0]))
+    else:
+        main(ROOT)
\ No newline at end of file
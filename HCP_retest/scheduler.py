@@ -0,0 +1,106 @@
+# Dependency-aware task scheduler for the per-subject pipeline stages.
+# Each task runs in its own worker process as soon as the tasks it depends
+# on have completed, subject to a global CPU budget: a task declares how
+# many cores it will use (eg, Toblerone's internal pool) and is only started
+# when that many are free. This replaces the per-stage barriers of
+# map_over_subjects and stops nested pools oversubscribing the machine.
+#
+# Ready tasks are started strictly in priority order: once one does not fit
+# in the free cores, nothing behind it is started until it has been, so the
+# cores being freed are kept for it. Otherwise a stream of small tasks (eg,
+# 1-core RC) could backfill ahead of a waiting 8-core Toblerone task
+# indefinitely.
+
+import concurrent.futures as cf
+
+
+class Task(object):
+    """
+    A unit of work.
+
+    Args:
+        name: unique identifier, used for dependencies
+        func: module-level function (so that it can be pickled)
+        args: tuple of arguments for func
+        cpus: number of cores the task will use
+        deps: names of tasks that must complete before this one starts
+        cost: predicted run time in seconds, for planning (see cost_model)
+    """
+
+    def __init__(self, name, func, args=(), cpus=1, deps=(), cost=0):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.cpus = cpus
+        self.deps = tuple(deps)
+        self.cost = cost
+
+    def __repr__(self):
+        return 'Task(%s)' % self.name
+
+
+def run_tasks(tasks, budget):
+    """
+    Run tasks, respecting their dependencies and the CPU budget. Ready tasks
+    are started in the order they were given, and none is started ahead of
+    a ready task that is waiting for cores. If a task fails, those that
+    depend on it (directly or otherwise) are skipped; a RuntimeError listing
+    all failures is raised once everything else has finished.
+
+    Returns:
+        dict of task name -> return value
+    """
+
+    names = [ t.name for t in tasks ]
+    if len(set(names)) != len(names):
+        raise ValueError("Task names must be unique")
+    missing = { d for t in tasks for d in t.deps } - set(names)
+    if missing:
+        raise ValueError("Unknown dependencies: %s" % sorted(missing))
+
+    pending = list(tasks)
+    running = {}
+    results = {}
+    failed = {}
+    free = budget
+
+    with cf.ProcessPoolExecutor(max_workers=budget) as executor:
+        while pending or running:
+
+            # Skip anything downstream of a failure
+            for t in [ t for t in pending if any(d in failed for d in t.deps) ]:
+                failed[t.name] = RuntimeError("dependency failed")
+                pending.remove(t)
+
+            # Start ready tasks in order while they fit within the free
+            # cores, stopping at the first that does not (no backfilling). A
+            # task asking for more than the whole budget gets all of it.
+            for t in list(pending):
+                if not all(d in results for d in t.deps):
+                    continue
+                need = min(t.cpus, budget)
+                if need > free:
+                    break
+                running[executor.submit(t.func, *t.args)] = t
+                pending.remove(t)
+                free -= need
+
+            if not running:
+                if pending:
+                    raise RuntimeError("Unsatisfiable dependencies: %s" % pending)
+                break
+
+            done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for fut in done:
+                t = running.pop(fut)
+                free += min(t.cpus, budget)
+                try:
+                    results[t.name] = fut.result()
+                except Exception as e:
+                    print("Task %s failed: %s" % (t.name, e))
+                    failed[t.name] = e
+
+    if failed:
+        raise RuntimeError("%d tasks failed: %s" % (len(failed), sorted(failed)))
+
+    return results
@@ -0,0 +1,469 @@
+# Synthetic HCP-like subjects, for exercising run_HCP without the HCP data,
+# FSL or Workbench (eg, to test scaling, or the analysis, at any number of
+# subjects). Each subject is written into the layout that run_HCP expects:
+#
+#   ROOT/{test,retest}/<id>/T1w/
+#       T1w_acpc_dc_restore.nii.gz, T1w_acpc_dc_restore_brain.nii.gz
+#       T1w_acpc_dc_restore_pve_{0,1,2}.nii.gz          (as FAST)
+#       ribbon.nii.gz                                   (FreeSurfer labels)
+#       Native/<id>.{L,R}.{white,pial,mid}.native.surf.gii
+#       processed/first/T1w_acpc_dc_restore-<struct>_first.vtk  (as FIRST)
+#       synthetic.json                                  (the anatomy)
+#
+# Each hemisphere is a bumpy sphere, as per the simulated surfaces (see
+# sim_surfaces/ground_truth.py), with its white and pial surfaces meshed
+# from an icosphere. Subjects differ in the size of their hemispheres and
+# the orientation of the bumps; the retest session of a subject differs
+# from its test session only slightly (as a rescan would). The FIRST
+# structures are small spheres within the white matter.
+#
+# Stand-ins for the external commands (fast, run_first_all and wb_command
+# -version) are written to ROOT/synthetic_tools. These produce their
+# outputs from a subject's synthetic.json, so the FAST and FIRST stages can
+# also be run for real (eg, with --no-outputs). Point run_HCP at the data
+# with the environment printed by the make command, eg:
+#
+#   python synth_subjects.py make /tmp/synth_hcp 200 --vox 1.4
+#   export PATH=/tmp/synth_hcp/synthetic_tools/bin:$PATH
+#   export FSLDIR=/tmp/synth_hcp/synthetic_tools HCP_ROOT=/tmp/synth_hcp
+#   python run_HCP.py
+#
+# At 0.7mm (the HCP's resolution) each subject takes ~0.5GB of memory and
+# a few seconds to generate; use --templates to generate only a few
+# distinct subjects and hard link the rest, for very large cohorts.
+
+import argparse
+import json
+import multiprocessing
+import os
+import os.path as op
+import shutil
+import stat
+import sys
+
+import nibabel
+import numpy as np
+
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..'))
+sys.path.append(op.join(op.dirname(op.abspath(__file__)), '..', 'sim_surfaces'))
+from ground_truth import bumpy_sphere_function
+from refgrids import RefGrid
+from toblerone.utils import STRUCTURES
+
+RUNS = ['test', 'retest']
+T1ROOT = 'T1w_acpc_dc_restore'
+
+# T1 field of view, as run_HCP.REFS (x is flipped)
+ORIGIN = [90, -126, -72]
+FOV = np.array([260, 311, 260]) * 0.7
+
+# Inner radius (mm) and outer:inner ratio of each hemisphere's bumpy
+# sphere, and the distance of the hemisphere centres from the midline
+BUMPY_DS = (38, 1.07)
+HEMI_OFFSET = 42
+
+# Brain mask extends this far (mm) beyond the pial surface, and the scalp
+# this far beyond that
+CSF_MARGIN = 3
+SCALP = 8
+
+# Supersampling (points per voxel side) for the PVE maps
+SUPERSAMPLE = 2
+
+# FreeSurfer ribbon labels: (WM, GM) for L and R
+RIBBON = { 'L': (2, 3), 'R': (41, 42) }
+
+
+def icosphere(order):
+    """Unit sphere vertices and triangles, subdivided from an icosahedron"""
+
+    g = (1 + np.sqrt(5)) / 2
+    points = np.array([[-1, g, 0], [1, g, 0], [-1, -g, 0], [1, -g, 0],
+        [0, -1, g], [0, 1, g], [0, -1, -g], [0, 1, -g],
+        [g, 0, -1], [g, 0, 1], [-g, 0, -1], [-g, 0, 1]], dtype=np.float64)
+    tris = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+        [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+        [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+        [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+
+    for _ in range(order):
+        # Split each edge once, at its (normalised) midpoint
+        edges = np.sort(np.concatenate((tris[:,[0,1]], tris[:,[1,2]], tris[:,[2,0]])), axis=1)
+        edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+        mids = points.shape[0] + inverse.reshape(3, -1).T
+        points = np.vstack((points, 0.5 * (points[edges[:,0]] + points[edges[:,1]])))
+        a, b, c = tris.T
+        ab, bc, ca = mids.T
+        tris = np.concatenate([ np.stack(t, axis=1) for t in
+            ((a, ab, ca), (b, bc, ab), (c, ca, bc), (ab, bc, ca)) ])
+
+    points /= np.linalg.norm(points, axis=1)[:,None]
+    return points, tris
+
+
+def anatomy(seed, run):
+    """
+    Parameters of one subject's anatomy (JSON serialisable). The retest
+    session is the test session rescaled very slightly.
+    """
+
+    rng = np.random.default_rng(seed)
+    scale = rng.uniform(0.9, 1.05)
+    angles = rng.uniform(0, 2 * np.pi, 2)
+    if run == 'retest':
+        scale *= 1 + rng.normal(0, 0.002)
+    centre = np.array(ORIGIN) + np.array([-1, 1, 1]) * FOV / 2
+    hemis = {}
+    for side, sign, angle in zip('LR', (-1, 1), angles):
+        hemis[side] = { 'centre': (centre + [sign * HEMI_OFFSET * scale, 0, 0]).tolist(),
+            'angle': float(angle), 'd1': BUMPY_DS[0] * scale, 'd2': BUMPY_DS[1] }
+    return { 'seed': int(seed), 'run': run, 'scale': float(scale), 'hemispheres': hemis }
+
+
+def _local(hemi, X, Y, Z):
+    # Coordinates relative to a hemisphere's centre, rotated about z
+    c, s = np.cos(hemi['angle']), np.sin(hemi['angle'])
+    x, y, z = X - hemi['centre'][0], Y - hemi['centre'][1], Z - hemi['centre'][2]
+    return c * x + s * y, -s * x + c * y, z
+
+
+def surfaces(hemi, order):
+    """White, pial and mid surfaces of one hemisphere, as (points, tris)"""
+
+    dirs, tris = icosphere(order)
+    c, s = np.cos(hemi['angle']), np.sin(hemi['angle'])
+    local = np.stack((c * dirs[:,0] + s * dirs[:,1], -s * dirs[:,0] + c * dirs[:,1],
+        dirs[:,2]), axis=1)
+    r_in, r_out = bumpy_sphere_function(hemi['d1'], hemi['d2'], *local.T)
+    centre = np.array(hemi['centre'])
+    white = centre + dirs * r_in[:,None]
+    pial = centre + dirs * r_out[:,None]
+    return { 'white': (white, tris), 'pial': (pial, tris),
+        'mid': (0.5 * (white + pial), tris) }
+
+
+def structures(anat):
+    """FIRST structures, as (name, centre, radius), within the white matter"""
+
+    out = []
+    for side in 'LR':
+        hemi = anat['hemispheres'][side]
+        names = [ s for s in STRUCTURES if s.startswith(side + '_') ]
+        for k, name in enumerate(names):
+            a = 2 * np.pi * k / len(names)
+            offset = 0.45 * hemi['d1'] * np.array([np.cos(a), np.sin(a), 0.3 * (-1) ** k])
+            out.append((name, np.array(hemi['centre']) + offset, 0.08 * hemi['d1']))
+    for name in [ s for s in STRUCTURES if s[0:2] not in ('L_', 'R_') ]:
+        centre = np.mean([ h['centre'] for h in anat['hemispheres'].values() ], axis=0)
+        out.append((name, centre - [0, 0, 0.5 * BUMPY_DS[0] * anat['scale']],
+            0.12 * BUMPY_DS[0] * anat['scale']))
+    return out
+
+
+def tissues(anat, affine, shape):
+    """
+    PVs (CSF, GM, WM) within the brain mask, and ribbon labels, on a voxel
+    grid. Only the bounding box of the brain is supersampled, a slab of z
+    at a time.
+    """
+
+    pves = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+    ribbon = np.zeros(shape, dtype=np.int16)
+    scalp = np.zeros(shape, dtype=bool)
+
+    # Voxel bounding box of both hemispheres, and the scalp around them
+    reach = max( h['d1'] * h['d2'] for h in anat['hemispheres'].values() ) + CSF_MARGIN + SCALP
+    corners = np.array([ [c[0] + dx, c[1] + dy, c[2] + dz]
+        for c in (h['centre'] for h in anat['hemispheres'].values())
+        for dx in (-reach, reach) for dy in (-reach, reach) for dz in (-reach, reach) ])
+    ijk = np.linalg.solve(affine, np.vstack((corners.T, np.ones(corners.shape[0]))))[0:3]
+    lo = np.clip(np.floor(ijk.min(1)).astype(int), 0, shape)
+    hi = np.clip(np.ceil(ijk.max(1)).astype(int) + 1, 0, shape)
+
+    n = SUPERSAMPLE
+    sub = (np.arange(n) + 0.5) / n - 0.5
+    for z0 in range(lo[2], hi[2], 2):
+        z1 = min(z0 + 2, hi[2])
+        grid = [ (np.arange(a, b)[:,None] + sub[None,:]).ravel()
+            for a, b in zip(lo[0:2], hi[0:2]) ] + [ (np.arange(z0, z1)[:,None] + sub).ravel() ]
+        I, J, K = np.meshgrid(*grid, indexing='ij')
+        X, Y, Z = [ affine[d,0] * I + affine[d,1] * J + affine[d,2] * K + affine[d,3]
+            for d in range(3) ]
+
+        wm = np.zeros(X.shape, dtype=bool)
+        gm = np.zeros(X.shape, dtype=bool)
+        mask = np.zeros(X.shape, dtype=bool)
+        head = np.zeros(X.shape, dtype=bool)
+        labels = np.zeros(X.shape, dtype=np.int16)
+        for side, hemi in anat['hemispheres'].items():
+            x, y, z = _local(hemi, X, Y, Z)
+            r = np.sqrt(x**2 + y**2 + z**2)
+            r_in, r_out = bumpy_sphere_function(hemi['d1'], hemi['d2'], x, y, z)
+            w, g = (r < r_in), (r >= r_in) & (r < r_out)
+            wm |= w
+            gm |= g
+            mask |= (r < r_out + CSF_MARGIN)
+            head |= (r < r_out + CSF_MARGIN + SCALP)
+            labels[w] = RIBBON[side][0]
+            labels[g] = RIBBON[side][1]
+        gm &= ~wm
+        csf = mask & ~(gm | wm)
+
+        # Mean over the subsamples of each voxel
+        size = (hi[0] - lo[0], n, hi[1] - lo[1], n, z1 - z0, n)
+        mean = lambda a: a.reshape(size).mean((1, 3, 5))
+        slab = (slice(lo[0], hi[0]), slice(lo[1], hi[1]), slice(z0, z1))
+        pves[slab] = np.stack([ mean(csf), mean(gm), mean(wm) ], axis=-1)
+        centre = (slice(n // 2, None, n),) * 3
+        ribbon[slab] = labels[centre]
+        scalp[slab] = (head & ~mask)[centre]
+
+    return pves, ribbon, scalp
+
+
+def _save(img, path):
+    # Via a temporary file, so hard linked copies (see templates) are not
+    # modified in place
+    tmp = op.join(op.dirname(path), '.%d.' % os.getpid() + op.basename(path))
+    nibabel.save(img, tmp)
+    os.replace(tmp, path)
+
+
+def _save_image(data, affine, path, dtype=np.float32):
+    nii = nibabel.Nifti1Image(data.astype(dtype), affine)
+    nii.set_data_dtype(dtype)
+    _save(nii, path)
+
+
+def write_surface(points, tris, side, path):
+    meta = { 'AnatomicalStructurePrimary': 'CortexLeft' if side == 'L' else 'CortexRight' }
+    gii = nibabel.gifti.GiftiImage(meta=nibabel.gifti.GiftiMetaData(meta), darrays=[
+        nibabel.gifti.GiftiDataArray(points.astype(np.float32), intent='NIFTI_INTENT_POINTSET',
+            datatype='NIFTI_TYPE_FLOAT32'),
+        nibabel.gifti.GiftiDataArray(tris.astype(np.int32), intent='NIFTI_INTENT_TRIANGLE',
+            datatype='NIFTI_TYPE_INT32') ])
+    _save(gii, path)
+
+
+def write_vtk(points, tris, path):
+    """Legacy ASCII VTK polydata, as written by FIRST"""
+
+    tmp = op.join(op.dirname(path), '.%d.' % os.getpid() + op.basename(path))
+    with open(tmp, 'w') as f:
+        f.write('# vtk DataFile Version 3.0\nthis file was written using fslsurface\n')
+        f.write('ASCII\nDATASET POLYDATA\nPOINTS %d float\n' % points.shape[0])
+        np.savetxt(f, points, fmt='%.6f')
+        f.write('POLYGONS %d %d\n' % (tris.shape[0], 4 * tris.shape[0]))
+        np.savetxt(f, np.hstack((np.full((tris.shape[0], 1), 3), tris)), fmt='%d')
+    os.replace(tmp, path)
+
+
+def load_anatomy(t1):
+    with open(op.join(op.dirname(op.abspath(t1)), 'synthetic.json'), 'r') as f:
+        return json.load(f)
+
+
+def run_fast(t1):
+    """FAST stand-in: _pve_{0,1,2} (CSF, GM, WM) alongside t1"""
+
+    if not op.isfile(t1):
+        t1 = t1 + '.nii.gz'
+    anat = load_anatomy(t1)
+    img = nibabel.load(t1)
+    pves, _, _ = tissues(anat, img.affine, img.shape[0:3])
+    base = t1[:-len('.nii.gz')] if t1.endswith('.nii.gz') else op.splitext(t1)[0]
+    for i in range(3):
+        _save_image(pves[...,i], img.affine, '%s_pve_%d.nii.gz' % (base, i))
+
+
+def run_first(t1, prefix):
+    """
+    FIRST stand-in: <prefix>-<struct>_first.vtk for each structure, in FSL
+    coordinates of t1 (voxel indices scaled by voxel size, x flipped if
+    the image is neurological)
+    """
+
+    anat = load_anatomy(t1)
+    img = nibabel.load(t1)
+    vox = np.abs(np.diag(img.affine)[0:3])
+    world2vox = np.linalg.inv(img.affine)
+    dirs, tris = icosphere(3)
+    for name, centre, radius in structures(anat):
+        points = centre + radius * dirs
+        ijk = points @ world2vox[0:3,0:3].T + world2vox[0:3,3]
+        if np.linalg.det(img.affine[0:3,0:3]) > 0:
+            ijk[:,0] = img.shape[0] - 1 - ijk[:,0]
+        write_vtk(ijk * vox, tris, '%s-%s_first.vtk' % (prefix, name))
+
+
+def subject_id(idx):
+    return '9%05d' % idx
+
+
+def write_subject(root, idx, run, vox=0.7, order=7, outputs=True, seed=0):
+    """
+    Write one session of one synthetic subject. If outputs, also write the
+    FAST and FIRST outputs (otherwise the stand-ins make them when run).
+    """
+
+    sid = subject_id(idx)
+    sd = op.join(root, run, sid, 'T1w')
+    os.makedirs(op.join(sd, 'Native'), exist_ok=True)
+    anat = anatomy(np.random.SeedSequence([seed, idx]).generate_state(1)[0], run)
+    anat['id'] = sid
+    with open(op.join(sd, 'synthetic.json'), 'w') as f:
+        json.dump(anat, f, indent=1)
+
+    for side, hemi in anat['hemispheres'].items():
+        for name, (points, tris) in surfaces(hemi, order).items():
+            write_surface(points, tris, side,
+                op.join(sd, 'Native', '%s.%s.%s.native.surf.gii' % (sid, side, name)))
+
+    # T1 contrast with noise, brain extracted and not
+    grid = RefGrid(ORIGIN, FOV, vox, flip=(True, False, False))
+    pves, ribbon, scalp = tissues(anat, grid.affine, grid.shape)
+    rng = np.random.default_rng([seed, idx, RUNS.index(run)])
+    brain = pves.sum(-1) > 0
+    t1 = pves @ np.array([300, 650, 1000], dtype=np.float32)
+    t1[brain] += rng.normal(0, 20, brain.sum()).astype(np.float32)
+    _save_image(t1, grid.affine, op.join(sd, T1ROOT + '_brain.nii.gz'))
+    t1[scalp] = 800 + rng.normal(0, 40, scalp.sum()).astype(np.float32)
+    _save_image(t1, grid.affine, op.join(sd, T1ROOT + '.nii.gz'))
+    _save_image(ribbon, grid.affine, op.join(sd, 'ribbon.nii.gz'), np.int16)
+    del t1, scalp, ribbon
+
+    # FAST's outputs are named as run_fast (and fast on the T1) names them.
+    # Any others already here are removed, as toblerone's loadFASTdir would
+    # take either set of _pve maps
+    stale = [T1ROOT + '_brain_pve_%d.nii.gz'] + ([] if outputs else [T1ROOT + '_pve_%d.nii.gz'])
+    for name in stale:
+        for i in range(3):
+            if op.isfile(op.join(sd, name % i)):
+                os.remove(op.join(sd, name % i))
+
+    if outputs:
+        for i in range(3):
+            _save_image(pves[...,i], grid.affine,
+                op.join(sd, T1ROOT + '_pve_%d.nii.gz' % i))
+        first = op.join(sd, 'processed', 'first')
+        os.makedirs(first, exist_ok=True)
+        run_first(op.join(sd, T1ROOT + '.nii.gz'), op.join(first, T1ROOT))
+
+
+def link_subject(root, src, idx, run):
+    """Copy of subject src as subject idx, hard linking all of its files"""
+
+    s, d = subject_id(src), subject_id(idx)
+    for dirpath, _, files in os.walk(op.join(root, run, s)):
+        out = op.join(root, run, d, op.relpath(dirpath, op.join(root, run, s)))
+        os.makedirs(out, exist_ok=True)
+        for f in files:
+            target = op.join(out, f.replace(s, d))
+            if f == 'synthetic.json':
+                with open(op.join(dirpath, f), 'r') as fin:
+                    anat = dict(json.load(fin), id=d, template=s)
+                with open(target, 'w') as fout:
+                    json.dump(anat, fout, indent=1)
+                continue
+            if not op.exists(target):
+                try:
+                    os.link(op.join(dirpath, f), target)
+                except OSError:
+                    shutil.copy2(op.join(dirpath, f), target)
+
+
+def write_tools(root):
+    """
+    Stand-ins for fast, run_first_all and wb_command (-version only), and an
+    FSLDIR for tool_version(). Returns the environment to run with.
+    """
+
+    tools = op.join(root, 'synthetic_tools')
+    os.makedirs(op.join(tools, 'bin'), exist_ok=True)
+    os.makedirs(op.join(tools, 'etc'), exist_ok=True)
+    with open(op.join(tools, 'etc', 'fslversion'), 'w') as f:
+        f.write('synthetic\n')
+
+    me = op.abspath(__file__)
+    scripts = {
+        'fast': '#!/bin/sh\nexec "%s" "%s" fast "$@"\n' % (sys.executable, me),
+        'run_first_all': '#!/bin/sh\nexec "%s" "%s" first "$@"\n' % (sys.executable, me),
+        'wb_command': ('#!/bin/sh\nif [ "$1" = "-version" ]; then echo "Version synthetic"; exit 0; fi\n'
+            'echo "wb_command stand-in only supports -version" >&2\nexit 1\n'),
+    }
+    for name, text in scripts.items():
+        path = op.join(tools, 'bin', name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return { 'PATH': op.join(tools, 'bin') + os.pathsep + '$PATH', 'FSLDIR': tools,
+        'HCP_ROOT': op.abspath(root) }
+
+
+def _write_job(args):
+    return write_subject(*args)
+
+
+def generate(root, n, vox=0.7, order=7, outputs=True, templates=None, seed=0, cores=None):
+    """
+    Write n synthetic subjects (test and retest sessions) into root, and the
+    stand-in tools. Only the first templates subjects (default all) are
+    generated; the rest are hard linked copies of these.
+
+    Returns:
+        environment variables to run the pipeline with
+    """
+
+    templates = min(templates or n, n)
+    jobs = [ (root, i, run, vox, order, outputs, seed) for i in range(templates) for run in RUNS ]
+    cores = min(cores or os.cpu_count(), len(jobs))
+    if cores == 1:
+        list(map(_write_job, jobs))
+    else:
+        with multiprocessing.Pool(cores) as p:
+            list(p.imap_unordered(_write_job, jobs))
+
+    for i in range(templates, n):
+        for run in RUNS:
+            link_subject(root, i % templates, i, run)
+
+    return write_tools(root)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Synthetic HCP-like subjects for run_HCP")
+    sub = parser.add_subparsers(dest='command')
+    make = sub.add_parser('make', help="write subjects")
+    make.add_argument('root')
+    make.add_argument('n', type=int)
+    make.add_argument('--vox', type=float, default=0.7, help="T1 voxel size (mm)")
+    make.add_argument('--order', type=int, default=7, help="icosphere subdivisions")
+    make.add_argument('--templates', type=int, help="distinct subjects to generate")
+    make.add_argument('--seed', type=int, default=0)
+    make.add_argument('--cores', type=int)
+    make.add_argument('--no-outputs', action='store_true',
+        help="leave the FAST and FIRST outputs to the stand-ins")
+
+    fast = sub.add_parser('fast', help="FAST stand-in")
+    fast.add_argument('-N', action='store_true')
+    fast.add_argument('input')
+
+    first = sub.add_parser('first', help="run_first_all stand-in")
+    first.add_argument('-i', required=True)
+    first.add_argument('-o', required=True)
+
+    args, _ = parser.parse_known_args()
+    if args.command == 'make':
+        env = generate(args.root, args.n, args.vox, args.order, not args.no_outputs,
+            args.templates, args.seed, args.cores)
+        print("Run the pipeline with:")
+        for k, v in env.items():
+            print('export %s=%s' % (k, v))
+    elif args.command == 'fast':
+        run_fast(args.input)
+    elif args.command == 'first':
+        run_first(args.i, args.o)
+    else:
+        parser.print_help()
@@ -0,0 +1,111 @@
+# Multi-resolution version of Toblerone's estimate_all. Called once per
+# voxel size, estimate_all repeats its resolution-independent setup every
+# time: loading the four cortical surfaces and the FIRST meshes (including
+# transforming the latter into world space). Here that setup is done once
+# per subject and shared by all reference grids; everything else is done per
+# grid exactly as estimate_all does it, including Toblerone's own resampling
+# of FAST.
+#
+# This mirrors the internals of estimate_all (pvestimation.complete) in the
+# toblerone 0.7 API, ie, that of classes.ImageSpace, utils._loadFIRSTdir and
+# pvestimation.estimators, which is what run_HCP is written against. It is
+# not an equivalent for any other version, so is only used by run_HCP once
+# check() has shown that it matches estimate_all for the installed version
+# (see run_HCP.TOB_MULTIRES).
+
+import numpy as np
+import regtricks as rt
+from toblerone import utils as tutils
+from toblerone.classes import ImageSpace, Surface, Hemisphere
+from toblerone.pvestimation import estimators
+
+# Largest absolute difference in any voxel of any output for which check()
+# passes (outputs are float32)
+CHECK_ATOL = 1e-5
+
+
+class SubjectSetup(object):
+    """
+    The resolution-independent inputs for one subject, loaded once.
+
+    Args:
+        LWS, LPS, RWS, RPS: paths to the L/R white and pial surfaces
+        fastdir: directory containing FAST's _pve_N images
+        firstdir: directory containing FIRST's .vtk meshes
+        struct: the structural image FIRST was run on
+    """
+
+    def __init__(self, LWS, LPS, RWS, RPS, fastdir, firstdir, struct):
+
+        self.hemispheres = [ Hemisphere(LWS, LPS, 'L'), Hemisphere(RWS, RPS, 'R') ]
+
+        # FIRST meshes are in FSL coordinates of the structural, which the
+        # Surface constructor transforms into world space
+        self.subcortical = [ Surface(path, 'first', struct, name)
+            for name, path in tutils._loadFIRSTdir(firstdir).items() ]
+
+        self.fasts = tutils._loadFASTdir(fastdir)
+
+
+def estimate_grid(setup, ref, cores=1):
+    """
+    Estimate PVs for all structures on one reference grid, as estimate_all.
+
+    Args:
+        setup: SubjectSetup
+        ref: path to the reference image
+        cores: number of processes for voxelisation
+
+    Returns:
+        dict of PV maps, as per estimate_all
+    """
+
+    struct2ref = np.eye(4)
+    space = ImageSpace(ref)
+    supersampler = np.ceil(space.vox_size.round(1) / 0.75).astype(np.int8)
+
+    # Resample FAST to the reference, then redefine CSF as 1 - (GM + WM)
+    s2r = rt.Registration(struct2ref)
+    output = { t: s2r.apply_to_image(setup.fasts[t], ref, superlevel=2).get_data()
+        for t in ['FAST_WM', 'FAST_GM'] }
+    output['FAST_CSF'] = np.maximum(0, 1 - (output['FAST_WM'] + output['FAST_GM']))
+
+    # The estimators work on their own copies of the surfaces, so those in
+    # setup are left as loaded for the next grid
+    for s in setup.subcortical:
+        output[s.name] = estimators._structure(s, space, struct2ref,
+            supersampler, False, cores)
+
+    ctx = estimators._cortex(setup.hemispheres, space, struct2ref,
+        supersampler, cores, False)
+    for i, tissue in enumerate(['_GM', '_WM', '_nonbrain']):
+        output['cortex' + tissue] = ctx[...,i]
+
+    stacked = estimators.stack_images({ k: v for k, v in output.items() if k != 'BrStem' })
+    output['GM'] = stacked[...,0]
+    output['WM'] = stacked[...,1]
+    output['nonbrain'] = stacked[...,2]
+    output['stacked'] = stacked
+    return output
+
+
+def check(ours, reference, atol=CHECK_ATOL):
+    """
+    Compare the outputs of estimate_grid and estimate_all for the same
+    subject and grid.
+
+    Returns:
+        (passed, diffs), where diffs is a dict of output -> largest absolute
+        difference (inf for outputs missing from either)
+    """
+
+    diffs = {}
+    for key in set(ours) | set(reference):
+        if key not in ours or key not in reference:
+            diffs[key] = np.inf
+            continue
+        a = np.asarray(ours[key], dtype=np.float64)
+        b = np.asarray(reference[key], dtype=np.float64)
+        diffs[key] = float(np.abs(a - b).max()) if a.shape == b.shape else np.inf
+
+    return all( d <= atol for d in diffs.values() ), diffs
@@ -0,0 +1,297 @@
+# Benchmarks for the PV estimation methods, swept over the same axes as the
+# experiments (voxel size, core count and surface density). Each case runs
+# in a fresh process, and its wall time, CPU time (including subprocesses),
+# peak RSS and output size are recorded to JSON. A run can be compared
+# against a stored baseline to flag regressions, eg after a toblerone
+# upgrade and before committing to a full 45-subject rerun.
+#
+# Usage:
+#   python benchmark.py run --out bench.json --sim-root <dir> \
+#       [--hcp-root <dir> --subject <id>] [--methods ...] [--voxsizes ...]
+#       [--cores 1 4] [--surfdirs <dir> ...]
+#   python benchmark.py compare bench.json baseline.json [--threshold 0.1]
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import os.path as op
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOTDIR = op.dirname(op.abspath(__file__))
+sys.path.append(op.join(ROOTDIR, 'HCP_retest'))
+sys.path.append(op.join(ROOTDIR, 'sim_surfaces'))
+
+METHODS = ['estimate_cortex', 'estimate_all', 'rc', 'fast_post', 'fast_resample']
+
+# Metrics compared against the baseline
+METRICS = ['wall', 'cpu', 'rss_mb']
+
+
+def _save(data, ref, outname):
+    import nibabel
+    refimg = nibabel.load(ref)
+    nibabel.save(nibabel.Nifti1Image(np.asarray(data, dtype=np.float32),
+        refimg.affine), outname)
+
+
+def _hcp_paths(hcp_root, subject):
+    # run_HCP takes its ROOT (and so where REFS caches its grids) from the
+    # environment at import, which _child sets before any case runs
+    import run_HCP
+    if op.abspath(run_HCP.ROOT) != op.abspath(hcp_root):
+        raise RuntimeError("run_HCP was imported with ROOT %s, not %s"
+            % (run_HCP.ROOT, hcp_root))
+    sub = op.join(hcp_root, 'test', subject)
+    return run_HCP, sub
+
+
+def run_method(case, outdir):
+    """Run one benchmark case, writing all outputs into outdir"""
+
+    method, v, cores = case['method'], case['vox'], case['cores']
+
+    if method == 'estimate_cortex':
+        import toblerone
+        import run_sim_surfaces
+        run_sim_surfaces.ROOT = case['sim_root']
+        surf = case.get('surf') or case['sim_root']
+        ref = run_sim_surfaces.refname(v)
+        out, _, _ = toblerone.estimate_cortex(LWS=op.join(surf, 'lh.white'),
+            LPS=op.join(surf, 'lh.pial'), ref=ref, struct2ref='I', cores=cores)
+        _save(out, ref, op.join(outdir, 'tob.nii.gz'))
+
+    elif method == 'estimate_all':
+        import toblerone
+        run_HCP, sub = _hcp_paths(case['hcp_root'], case['subject'])
+        sd = op.join(sub, 'T1w')
+        native = lambda s: op.join(sd, 'Native', '%s.%s.native.surf.gii' % (case['subject'], s))
+        ref = run_HCP.REFS.path(v)
+        pvs, _ = toblerone.estimate_all(LWS=native('L.white'), LPS=native('L.pial'),
+            RWS=native('R.white'), RPS=native('R.pial'), ref=ref, struct2ref='I',
+            fastdir=sd, firstdir=op.join(sd, 'processed', 'first'),
+            struct=op.join(sd, run_HCP.T1ROOT + '.nii.gz'), cores=cores)
+        for key, img in pvs.items():
+            _save(img, ref, op.join(outdir, 'tob_%s.nii.gz' % key))
+
+    elif method == 'rc':
+        from image_scripts import do_RC
+        run_HCP, sub = _hcp_paths(case['hcp_root'], case['subject'])
+        native = lambda s: op.join(sub, 'T1w', 'Native', '%s.%s.native.surf.gii' % (case['subject'], s))
+        do_RC(LPS=native('L.pial'), RPS=native('R.pial'), LWS=native('L.white'),
+            RWS=native('R.white'), RMS=native('R.mid'), LMS=native('L.mid'),
+            outname=op.join(outdir, 'RC.nii.gz'), vox=v, ref=run_HCP.REFS.path(v))
+
+    elif method == 'fast_post':
+        run_HCP, sub = _hcp_paths(case['hcp_root'], case['subject'])
+        run_HCP.fast_postprocess(op.join(sub, 'T1w'), outdir, threads=cores)
+
+    elif method == 'fast_resample':
+        # Whichever resampler the pipeline is set to use
+        run_HCP, sub = _hcp_paths(case['hcp_root'], case['subject'])
+        base = op.join(sub, 'T1w', 'processed', 'fast_base_brain.nii.gz')
+        outname = op.join(outdir, 'fast.nii.gz')
+        if run_HCP.FAST_RESAMPLE_IN_PROCESS:
+            run_HCP.resampling.resample(base, outname, run_HCP.REFS.grid(v))
+        else:
+            run_HCP.resample(base, outname, run_HCP.REFS.path(v))
+
+    else:
+        raise ValueError("Unknown method %s" % method)
+
+
+def _preload(case):
+    # Import whatever the method uses, so that the timings cover only the
+    # method itself
+    method = case['method']
+    if method in ('estimate_cortex', 'estimate_all'):
+        import toblerone
+    if method == 'estimate_cortex':
+        import run_sim_surfaces
+    else:
+        import run_HCP
+    if method == 'rc':
+        import image_scripts
+
+
+def _child(case, conn):
+    """Entry point of the fresh process that runs a single case"""
+
+    if case['hcp_root']:
+        os.environ['HCP_ROOT'] = case['hcp_root']
+
+    outdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        _preload(case)
+        t0 = time.perf_counter()
+        r0 = [ resource.getrusage(w) for w in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+        run_method(case, outdir)
+        wall = time.perf_counter() - t0
+        r1 = [ resource.getrusage(w) for w in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN) ]
+
+        cpu = sum( (b.ru_utime + b.ru_stime) - (a.ru_utime + a.ru_stime)
+            for a, b in zip(r0, r1) )
+        # ru_maxrss is in kB on Linux
+        rss = max( r.ru_maxrss for r in r1 ) / 1024
+        size = sum( op.getsize(f) for f in
+            glob.glob(op.join(outdir, '**'), recursive=True) if op.isfile(f) )
+        conn.send({ 'wall': wall, 'cpu': cpu, 'rss_mb': rss, 'out_bytes': size })
+
+    except Exception as e:
+        conn.send({ 'error': repr(e) })
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+        conn.close()
+
+
+def run_case(case):
+    """Run a case in a fresh interpreter and return its measurements"""
+
+    ctx = multiprocessing.get_context('spawn')
+    recv, send = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(case, send))
+    p.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = { 'error': 'process exited with code %s' % p.exitcode }
+    p.join()
+    return dict(case, **result)
+
+
+def case_key(r):
+    return (r['method'], '%1.2f' % r['vox'], r['cores'], r.get('surf') or '')
+
+
+def build_cases(args):
+    surfs = args.surfdirs or [None]
+    cases = []
+    for method in args.methods:
+        if method == 'estimate_cortex' and not args.sim_root:
+            raise ValueError("Method %s requires --sim-root" % method)
+        if method != 'estimate_cortex' and not (args.hcp_root and args.subject):
+            raise ValueError("Method %s requires --hcp-root and --subject" % method)
+        for v in args.voxsizes:
+            for cores in args.cores:
+                for surf in (surfs if method == 'estimate_cortex' else [None]):
+                    cases.append({ 'method': method, 'vox': float(v), 'cores': cores,
+                        'surf': surf, 'sim_root': args.sim_root,
+                        'hcp_root': args.hcp_root, 'subject': args.subject })
+    return cases
+
+
+def run(args):
+    results = []
+    for case in build_cases(args):
+        r = run_case(case)
+        results.append(r)
+        if 'error' in r:
+            print('%-16s %5.2f  %2d cores  FAILED: %s' % (r['method'], r['vox'], r['cores'], r['error']))
+        else:
+            print('%-16s %5.2f  %2d cores  wall %8.1fs  cpu %8.1fs  rss %7.0fMB  out %6.1fMB' % (
+                r['method'], r['vox'], r['cores'], r['wall'], r['cpu'],
+                r['rss_mb'], r['out_bytes'] / 2**20))
+
+    meta = { 'host': platform.node(), 'python': platform.python_version(),
+        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S') }
+    try:
+        import toblerone
+        meta['toblerone'] = str(getattr(toblerone, '__version__', 'unknown'))
+    except ImportError:
+        pass
+
+    with open(args.out, 'w') as f:
+        json.dump({ 'meta': meta, 'results': results }, f, indent=1)
+
+
+def compare(current, baseline, threshold):
+    """
+    Compare two sets of results.
+
+    Returns:
+        (regressions, failures, missing, new): regressions are cases where
+        a metric exceeds the baseline by more than threshold (fractional),
+        as (key, metric, baseline, current); failures are cases that passed
+        in the baseline but failed now, as (key, error); missing are the
+        keys of baseline cases absent from the current run, and new those
+        of current cases absent from the baseline
+    """
+
+    base = { case_key(r): r for r in baseline['results'] }
+    cur = { case_key(r): r for r in current['results'] }
+    regressions, failures = [], []
+    for key, r in cur.items():
+        b = base.get(key)
+        if b is None or 'error' in b:
+            continue
+        if 'error' in r:
+            failures.append((key, r['error']))
+            continue
+        for m in METRICS:
+            if b[m] > 0 and (r[m] - b[m]) / b[m] > threshold:
+                regressions.append((key, m, b[m], r[m]))
+
+    missing = [ k for k in base if k not in cur ]
+    new = [ k for k in cur if k not in base ]
+    return regressions, failures, missing, new
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('run', help='run the benchmarks')
+    p.add_argument('--out', required=True)
+    p.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS)
+    p.add_argument('--voxsizes', nargs='+', type=float, default=[1.0, 2.0, 3.0])
+    p.add_argument('--cores', nargs='+', type=int, default=[1, 4])
+    p.add_argument('--surfdirs', nargs='+', help='sim surface dirs of varying density')
+    p.add_argument('--sim-root')
+    p.add_argument('--hcp-root')
+    p.add_argument('--subject')
+
+    p = sub.add_parser('compare', help='compare results against a baseline')
+    p.add_argument('current')
+    p.add_argument('baseline')
+    p.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run(args)
+
+    elif args.command == 'compare':
+        with open(args.current) as f:
+            current = json.load(f)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions, failures, missing, new = compare(current, baseline, args.threshold)
+        name = lambda key: ' '.join(str(k) for k in key if k != '')
+        for key, m, b, c in regressions:
+            print('REGRESSION %s %s: %.2f -> %.2f (%+.0f%%)' % (
+                name(key), m, b, c, 100 * (c - b) / b))
+        for key, error in failures:
+            print('FAILED %s: %s' % (name(key), error))
+        for key in missing:
+            print('MISSING %s: in the baseline but not this run' % name(key))
+        for key in new:
+            print('NEW %s: not in the baseline' % name(key))
+        if regressions or failures or missing:
+            sys.exit(1)
+        print('No regressions beyond %.0f%%' % (100 * args.threshold))
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
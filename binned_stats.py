@@ -0,0 +1,73 @@
+# Binned statistics, computed in a single pass over the data
+
+import numpy as np
+
+
+def binned_stats(x, values, bins, weights=None):
+    """
+    Per-bin statistics of values, with samples sorted into bins by x.
+    Binning follows np.digitize: sample i falls in bin b if
+    bins[b] <= x[i] < bins[b+1], and samples outside of the bins are dropped.
+    Empty bins have a mean (and variance) of NaN, as per np.mean.
+
+    Args:
+        x: array of N values to bin by
+        values: array sized N or N x T (eg, one column per tissue)
+        bins: array of B+1 bin edges
+        weights: optional array of N sample weights
+
+    Returns:
+        dict with keys 'count' (B), 'mean' and 'var' (B x T), and 'wmean'
+        (B x T) if weights were given. If values is 1D, the trailing T
+        dimension is dropped.
+    """
+
+    values = np.asanyarray(values)
+    flat = (values.ndim == 1)
+    if flat:
+        values = values[:,None]
+    nbins = np.size(bins) - 1
+    ntiss = values.shape[1]
+
+    # Bin index of each sample, then a flat (bin, column) index so that one
+    # bincount accumulates all columns at once
+    inds = np.digitize(x, bins) - 1
+    keep = (inds >= 0) & (inds < nbins)
+    inds = inds[keep]
+    values = values[keep,:].astype(np.float64)
+    flat_inds = (inds[:,None] * ntiss + np.arange(ntiss)[None,:]).ravel()
+    size = nbins * ntiss
+
+    count = np.bincount(inds, minlength=nbins)
+    total = np.bincount(flat_inds, values.ravel(), size).reshape(nbins, ntiss)
+    total_sq = np.bincount(flat_inds, (values ** 2).ravel(), size).reshape(nbins, ntiss)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count[:,None]
+        var = np.maximum(total_sq / count[:,None] - mean ** 2, 0)
+
+    out = { 'count': count, 'mean': mean, 'var': var }
+
+    if weights is not None:
+        w = np.asanyarray(weights)[keep].astype(np.float64)
+        wsum = np.bincount(inds, w, nbins)
+        wtotal = np.bincount(flat_inds, (values * w[:,None]).ravel(), size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['wmean'] = wtotal.reshape(nbins, ntiss) / wsum[:,None]
+
+    if flat:
+        out = { k: (a[:,0] if a.ndim > 1 else a) for k,a in out.items() }
+    return out
+
+
+def weighted_mean(a, weights, axis=0):
+    """
+    Weighted average of a along an axis, ignoring NaN entries (eg, the
+    empty bins produced by binned_stats).
+    """
+
+    a = np.moveaxis(np.asanyarray(a, dtype=np.float64), axis, 0)
+    w = np.asanyarray(weights, dtype=np.float64)
+    w = w.reshape(-1, *([1] * (a.ndim - 1))) * ~np.isnan(a)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(a * w, axis=0) / w.sum(0)
@@ -0,0 +1,178 @@
+# Cost model for planning the per-subject pipeline. Each task is described
+# by a scalar amount of work, derived from its inputs (eg, brain volume for
+# FAST, or surface vertices over all voxel sizes for Toblerone), and its
+# cost predicted as a per-stage rate (seconds per unit of work) times that.
+# Rates start from a rough prior and are replaced by the median rate seen in
+# past runs, from the telemetry they recorded, once there are enough.
+#
+# Tasks are then dispatched longest first (LPT), so that the slowest
+# subjects do not straggle at the end of a stage, and the makespan of a
+# plan is predicted by simulating the same greedy dispatch with the
+# predicted costs.
+#
+# Input features can be slow to compute (eg, loading a T1), so are kept in
+# a FeatureIndex keyed by the size and mtime of their source files. They are
+# not computed when planning: whatever the index does not yet hold takes the
+# priors' typical work, and is filled in by the tasks themselves as they run.
+
+import fcntl
+import heapq
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+import telemetry
+from results_store import stamps
+
+# Past runs must have at least this many tasks of a stage for their
+# measured rate to replace the prior
+MIN_SAMPLES = 3
+
+# Tasks that took less time than this (eg, those skipped because their
+# outputs were up to date) are not used to measure rates
+MIN_SECONDS = 1.0
+
+
+class FeatureIndex(object):
+    """Features of input files, cached in a JSON file against their stamps"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = self._read()
+        self.updates = {}
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def key(self, name, sources):
+        return name + ':' + '|'.join(sorted(stamps(sources)))
+
+    def get(self, name, sources):
+        """Cached value of feature name, if its sources are unchanged"""
+
+        entry = self.index.get(self.key(name, sources))
+        if entry is not None and entry['stamps'] == stamps(sources):
+            return entry['value']
+        return None
+
+    def set(self, name, sources, value):
+        entry = { 'stamps': stamps(sources), 'value': value }
+        self.index[self.key(name, sources)] = entry
+        self.updates[self.key(name, sources)] = entry
+
+    def save(self):
+        """
+        Add the features set here to the index on disk. Several processes 
+        (eg, tasks running at once) may save to the same index: each adds 
+        its own entries to what is there under a file lock.
+        """
+
+        if not self.updates:
+            return
+        os.makedirs(op.dirname(op.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.index = dict(self._read(), **self.updates)
+            tmp = self.path + '.%d.tmp' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp, self.path)
+        self.updates = {}
+
+
+class CostModel(object):
+    """
+    Predicted seconds per task, as a per-stage rate times the task's work.
+
+    Args:
+        priors: dict of stage -> seconds per unit of work, used for stages
+            without enough history
+    """
+
+    def __init__(self, priors):
+        self.priors = dict(priors)
+        self.samples = {}
+
+    def observe(self, stage, work, seconds):
+        """Add a measured runtime from a past run"""
+
+        if (seconds >= MIN_SECONDS) and np.isfinite(work) and (work > 0):
+            self.samples.setdefault(stage, []).append(seconds / work)
+
+    def rate(self, stage):
+        samples = self.samples.get(stage, [])
+        if len(samples) >= MIN_SAMPLES:
+            return float(np.median(samples))
+        return self.priors[stage]
+
+    def predict(self, stage, work):
+        return self.rate(stage) * work
+
+
+def history(directory):
+    """
+    Successful calls recorded by telemetry anywhere within directory (ie,
+    from all past runs), as (stage, call args, wall seconds)
+    """
+
+    out = []
+    if not op.isdir(directory):
+        return out
+    for d, _, files in os.walk(directory):
+        if not any( f.startswith('events_') for f in files ):
+            continue
+        for e in telemetry.load_events(d):
+            if e['error'] is None and 'call' in e['args']:
+                out.append((e['stage'], tuple(e['args']['call']), e['end'] - e['start']))
+    return out
+
+
+def longest_first(items, costs):
+    """items sorted by decreasing cost (ties keep their order)"""
+
+    return [ items[i] for i in sorted(range(len(items)), key=lambda i: -costs[i]) ]
+
+
+def makespan(tasks, budget):
+    """
+    Predicted wall time to run tasks within a CPU budget, dispatched as per
+    scheduler.run_tasks: whenever cores are free, ready tasks are started in
+    the order given, up to the first that does not fit.
+
+    Args:
+        tasks: objects with name, cost (seconds), cpus and deps attributes,
+            eg scheduler.Task
+        budget: number of cores
+    """
+
+    pending = list(tasks)
+    done = set()
+    running = []
+    free = budget
+    now = 0.0
+
+    while pending or running:
+        for t in list(pending):
+            if not all(d in done for d in t.deps):
+                continue
+            need = min(t.cpus, budget)
+            if need > free:
+                break
+            heapq.heappush(running, (now + t.cost, t.name, need))
+            pending.remove(t)
+            free -= need
+
+        if not running:
+            raise RuntimeError("Unsatisfiable dependencies: %s" % pending)
+
+        now, name, need = heapq.heappop(running)
+        done.add(name)
+        free += need
+
+    return now
@@ -0,0 +1,146 @@
+# Cached, parallel figure building for the analysis scripts. Each figure is
+# a Figure job: a plotting function, the arrays and parameters it draws from,
+# and the file it is saved to. A job's key is a hash of all of these (plus
+# the source of the plotting function and the savefig options), recorded
+# in a small index alongside the figures. build() then skips every figure
+# whose key is unchanged and whose file still exists, and renders the rest
+# in a process pool. Changing one panel therefore only redraws that panel.
+#
+# Plotting functions are called as func(fig, *args, **params) with a new
+# figure, and draw on axes they add to it (fig.add_subplot) rather than
+# through pyplot. They must be defined at module level (so that they can be
+# sent to the pool), and must take everything they draw from (including
+# module constants such as voxel sizes and colours) as arguments: only
+# the arguments and the function's own source are hashed, so a change to a
+# global it reads would not redraw the figure.
+
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import os.path as op
+
+import numpy as np
+
+# Index of figure keys, kept in the same directory as the figures
+INDEX = '.figure_cache.json'
+
+
+def _update(h, obj):
+    # Feed a (nested) plotting input into hash h, arrays by content
+    if isinstance(obj, np.ndarray):
+        obj = np.ascontiguousarray(obj)
+        h.update(('array %s %s;' % (obj.dtype.str, obj.shape)).encode())
+        h.update(obj.view(np.uint8) if obj.dtype != object else repr(obj.tolist()).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(('%s %d;' % (type(obj).__name__, len(obj))).encode())
+        for o in obj:
+            _update(h, o)
+    elif isinstance(obj, dict):
+        h.update(('dict %d;' % len(obj)).encode())
+        for k in sorted(obj, key=str):
+            _update(h, k)
+            _update(h, obj[k])
+    else:
+        h.update(('%s %r;' % (type(obj).__name__, obj)).encode())
+
+
+class Figure(object):
+    """
+    One figure to build.
+
+    Args:
+        target: path to save the figure to
+        func: plotting function, called as func(fig, *args, **params)
+        args, params: the arrays and plotting parameters to pass
+    """
+
+    def __init__(self, target, func, *args, **params):
+        self.target = target
+        self.func = func
+        self.args = args
+        self.params = params
+
+    def key(self, savekws):
+        h = hashlib.sha1()
+        try:
+            source = inspect.getsource(self.func)
+        except (OSError, TypeError):
+            source = self.func.__qualname__
+        _update(h, source)
+        _update(h, [self.args, self.params, savekws])
+        return h.hexdigest()
+
+
+def _index_path(target):
+    return op.join(op.dirname(op.abspath(target)), INDEX)
+
+
+def _load_index(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _init_worker():
+    # Render off-screen in the pool, whatever backend the parent is using
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _render(job, savekws):
+    import matplotlib.pyplot as plt
+    fig = plt.figure()
+    try:
+        job.func(fig, *job.args, **job.params)
+        fig.savefig(job.target, **savekws)
+    finally:
+        plt.close(fig)
+    return job.target
+
+
+def build(jobs, savekws=None, cores=None, force=False):
+    """
+    Render the figures that are out of date.
+
+    Args:
+        jobs: list of Figure
+        savekws: options for savefig, common to all figures
+        cores: number of processes (default all)
+        force: render every figure, regardless of the cache
+
+    Returns:
+        list of the targets that were rendered
+    """
+
+    savekws = savekws or {}
+    keys = [ j.key(savekws) for j in jobs ]
+    indexes = { p: _load_index(p) for p in { _index_path(j.target) for j in jobs } }
+    stale = [ (j, k) for j, k in zip(jobs, keys) if force
+        or not op.isfile(j.target)
+        or indexes[_index_path(j.target)].get(op.basename(j.target)) != k ]
+
+    for j, _ in stale:
+        os.makedirs(op.dirname(op.abspath(j.target)), exist_ok=True)
+
+    cores = min(cores or os.cpu_count(), len(stale))
+    if cores <= 1:
+        done = [ _render(j, savekws) for j, _ in stale ]
+    else:
+        with multiprocessing.Pool(cores, initializer=_init_worker) as p:
+            done = p.starmap(_render, [ (j, savekws) for j, _ in stale ])
+
+    # Only record keys once rendered, so a failed figure is retried next time
+    for j, k in stale:
+        indexes[_index_path(j.target)][op.basename(j.target)] = k
+    for path, index in indexes.items():
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+
+    print('Figures: rendered %d, unchanged %d' % (len(done), len(jobs) - len(done)))
+    return done
@@ -0,0 +1,170 @@
+# Incremental build manifest. For every output in a directory, the manifest
+# records the fingerprints of the inputs it was made from and the
+# parameters (voxel size, reference, tool versions...) that were used.
+# An output is then rebuilt only if it is missing or any of these change.
+#
+# Input fingerprints are cheap to check: if an input's size and mtime are
+# as recorded it is taken as unchanged; only if they differ is the content
+# hash computed and compared (so touched or copied files do not trigger a
+# rebuild).
+
+import fcntl
+import functools
+import glob
+import hashlib
+import json
+import os
+import os.path as op
+import subprocess
+
+MANIFEST_NAME = 'manifest.json'
+
+# Outputs that exist but have no record (ie, that predate the manifest) are
+# rebuilt. If set, those that are newer than all of their inputs are instead
+# taken as valid, and recorded against their current inputs on first check
+# (which hashes each of those inputs)
+ADOPT_UNRECORDED = False
+
+# Content hashes, keyed by (path, size, mtime), computed by this process
+_HASHES = {}
+
+
+def file_hash(path):
+    st = os.stat(path)
+    key = (op.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _HASHES:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(functools.partial(f.read, 2 ** 20), b''):
+                h.update(block)
+        _HASHES[key] = h.hexdigest()
+    return _HASHES[key]
+
+
+def fingerprint(path, content=True):
+    st = os.stat(path)
+    fp = { 'size': st.st_size, 'mtime': st.st_mtime_ns }
+    if content:
+        fp['sha256'] = file_hash(path)
+    return fp
+
+
+def input_matches(path, recorded):
+    """Does the input at path match its recorded fingerprint?"""
+
+    try:
+        fp = fingerprint(path, content=False)
+    except FileNotFoundError:
+        return False
+
+    if fp['size'] != recorded['size']:
+        return False
+    if fp['mtime'] == recorded['mtime']:
+        return True
+    return ('sha256' in recorded) and (file_hash(path) == recorded['sha256'])
+
+
+@functools.lru_cache()
+def tool_version(tool):
+    """Version string of an external tool (or Python package)"""
+
+    try:
+        if tool == 'fsl':
+            with open(op.join(os.environ['FSLDIR'], 'etc', 'fslversion')) as f:
+                return f.read().strip()
+        if tool == 'wb_command':
+            out = subprocess.run(['wb_command', '-version'],
+                stdout=subprocess.PIPE, universal_newlines=True).stdout
+            return ' '.join( l.strip() for l in out.splitlines()
+                if l.strip().startswith('Version') )
+        mod = __import__(tool)
+        return str(getattr(mod, '__version__', 'unknown'))
+    except Exception:
+        return 'unknown'
+
+
+def directory_inputs(d, pattern='*'):
+    """All files within a directory matching pattern, eg FIRST outputs"""
+    return sorted(glob.glob(op.join(d, pattern)))
+
+
+def _normalise(params):
+    # Round-trip through JSON so that tuples, numpy scalars etc compare
+    # equal to what is read back from disk
+    return json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+
+
+class Manifest(object):
+    """
+    Build records for the outputs within one directory, stored alongside
+    them as manifest.json. Writes are serialised with a file lock, so
+    several processes may update the same manifest.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = op.join(directory, MANIFEST_NAME)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _update(self, key, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            records = self._read()
+            records[key] = entry
+            tmp = self.path + '.%d.tmp' % os.getpid()
+            with open(tmp, 'w') as f:
+                json.dump(records, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    @staticmethod
+    def _newer_than(output, inputs):
+        # Output was modified after every one of its inputs (which all exist)
+        mtime = os.stat(output).st_mtime_ns
+        try:
+            return all( os.stat(i).st_mtime_ns <= mtime for i in inputs )
+        except FileNotFoundError:
+            return False
+
+    def record(self, output, inputs=(), params=None):
+        """Record that output has been made from inputs, with params"""
+
+        entry = {
+            'inputs': { op.abspath(i): fingerprint(i) for i in inputs },
+            'params': _normalise(params),
+            'output': fingerprint(output, content=False),
+        }
+        self._update(op.basename(output), entry)
+
+    def is_current(self, output, inputs=(), params=None):
+        """
+        Is output up to date with respect to inputs and params? Returns
+        False if the output does not exist.
+        """
+
+        if not op.exists(output):
+            return False
+
+        entry = self._read().get(op.basename(output))
+        if entry is None:
+            if ADOPT_UNRECORDED and self._newer_than(output, inputs):
+                self.record(output, inputs, params)
+                return True
+            return False
+
+        if entry['params'] != _normalise(params):
+            return False
+        if set(entry['inputs']) != { op.abspath(i) for i in inputs }:
+            return False
+
+        out = fingerprint(output, content=False)
+        if out != entry['output']:
+            return False
+
+        return all( input_matches(p, fp) for p, fp in entry['inputs'].items() )
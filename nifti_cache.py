@@ -0,0 +1,93 @@
+# Decompressed, memory-mapped cache of NIfTI images. Each image is decoded
+# once to an uncompressed float32 .npy file, keyed by its path, mtime and
+# size, and thereafter mapped read-only (so many worker processes can share
+# the same copy). The total size of the cache is kept within a disk budget
+# by evicting the least recently used entries.
+
+import hashlib
+import os
+import os.path as op
+
+import nibabel
+import numpy as np
+
+# Both may be overridden via the environment, or set directly on the module
+CACHE_DIR = os.environ.get('NIFTI_CACHE_DIR',
+    op.join(op.expanduser('~'), '.cache', 'nifti_cache'))
+CACHE_BUDGET = int(os.environ.get('NIFTI_CACHE_BUDGET', 20 * (2 ** 30)))
+
+
+def cache_key(path):
+    st = os.stat(path)
+    ident = '%s:%d:%d' % (op.abspath(path), st.st_mtime_ns, st.st_size)
+    return hashlib.sha1(ident.encode()).hexdigest()
+
+
+def cache_path(path, cache_dir=None):
+    return op.join(cache_dir or CACHE_DIR, cache_key(path) + '.npy')
+
+
+def load(path, cache_dir=None, budget=None):
+    """
+    Image data as a read-only float32 array, memory-mapped from the cache.
+    The image is decoded and added to the cache on first use.
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    cpath = cache_path(path, cache_dir)
+
+    try:
+        data = np.load(cpath, mmap_mode='r')
+        os.utime(cpath)
+        return data
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data = nibabel.load(path).get_fdata(dtype=np.float32)
+
+    # Write under a temporary name so that other processes never map a
+    # partially written file
+    tmp = cpath + '.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp, cpath)
+    evict(cache_dir, CACHE_BUDGET if budget is None else budget, keep=cpath)
+
+    return np.load(cpath, mmap_mode='r')
+
+
+def evict(cache_dir=None, budget=None, keep=None):
+    """
+    Remove least recently used entries until the cache fits within budget
+    bytes. Files that are currently mapped by other processes remain valid
+    until they are unmapped.
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    budget = CACHE_BUDGET if budget is None else budget
+
+    entries = []
+    for d in os.scandir(cache_dir):
+        if d.name.endswith('.npy'):
+            try:
+                st = d.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, d.path))
+
+    total = sum( e[1] for e in entries )
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear(cache_dir=None):
+    evict(cache_dir, 0)
@@ -0,0 +1,151 @@
+# Registry of reference voxel grids. Each grid is defined by the world
+# position of its first voxel, a field of view and a voxel size, from which
+# ImageSpace objects are created directly. Reference images are only
+# written to disk when an external tool needs to read one, and derived
+# arrays (voxel centres) are cached as memory-mappable .npy files.
+
+import hashlib
+import os
+import os.path as op
+
+import nibabel
+import numpy as np
+import toblerone as t
+
+
+class RefGrid(object):
+    """
+    An axis-aligned voxel grid.
+
+    Args:
+        origin: world coordinates of the centre of voxel (0,0,0)
+        fov: size of the field of view (mm), rounded up to whole voxels
+        vox_size: isotropic voxel size (mm)
+        flip: per-axis flags, True where voxel index increases in the
+            negative world direction (eg, radiological x)
+    """
+
+    def __init__(self, origin, fov, vox_size, flip=(False, False, False)):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.fov = np.asarray(fov, dtype=np.float64)
+        self.vox_size = float(vox_size)
+        self.flip = tuple(bool(f) for f in flip)
+
+    @property
+    def shape(self):
+        return tuple(int(s) for s in np.ceil(self.fov / self.vox_size))
+
+    @property
+    def affine(self):
+        signs = np.where(self.flip, -1.0, 1.0)
+        aff = np.diag(np.append(signs * self.vox_size, 1))
+        aff[0:3,3] = self.origin
+        return aff
+
+    @property
+    def key(self):
+        h = hashlib.sha1(np.round(self.affine, 6).tobytes())
+        h.update(np.asarray(self.shape, dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    def describe(self):
+        """Plain description of the grid, eg for build records"""
+        return { 'shape': list(self.shape), 'affine': self.affine.tolist() }
+
+    def bounds(self):
+        """World-space min and max corners of the grid's bounding box"""
+
+        corners = np.array([ [i, j, k] for i in (-0.5, self.shape[0] - 0.5)
+            for j in (-0.5, self.shape[1] - 0.5)
+            for k in (-0.5, self.shape[2] - 0.5) ])
+        world = corners @ self.affine[0:3,0:3].T + self.affine[0:3,3]
+        return world.min(0), world.max(0)
+
+    def centres(self, cache_dir=None):
+        """
+        World coordinates of all voxel centres, sized (voxels x 3) in
+        C-order, as float32. If cache_dir is given these are saved there
+        on first use and memory-mapped thereafter.
+        """
+
+        path = op.join(cache_dir, 'centres_%s.npy' % self.key) if cache_dir else None
+        if path and op.isfile(path):
+            return np.load(path, mmap_mode='r')
+
+        ijk = np.indices(self.shape, dtype=np.float32).reshape(3, -1).T
+        world = ijk @ self.affine[0:3,0:3].T.astype(np.float32)
+        world += self.affine[0:3,3].astype(np.float32)
+        if path is None:
+            return world
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, world)
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+    def space(self):
+        return t.classes.ImageSpace.manual(self.affine, self.shape)
+
+    def write(self, path):
+        """Write an empty reference image for this grid"""
+
+        img = nibabel.Nifti1Image(np.zeros(self.shape, dtype=np.float32), self.affine)
+        img.set_sform(self.affine, code=1)
+        img.set_qform(self.affine, code=1)
+        tmp = op.join(op.dirname(path), '.%d.' % os.getpid() + op.basename(path))
+        nibabel.save(img, tmp)
+        os.replace(tmp, path)
+
+    def matches(self, path):
+        """Does the image at path have this grid's shape and affine?"""
+
+        hdr = nibabel.load(path).header
+        return (tuple(hdr['dim'][1:4]) == self.shape
+            and np.allclose(hdr.get_best_affine(), self.affine, atol=1e-3))
+
+
+class GridRegistry(object):
+    """
+    A family of grids sharing origin and FoV, one per voxel size.
+
+    Args:
+        origin, fov, flip: as per RefGrid
+        namer: function mapping voxel size to the path of its reference image
+        cache_dir: directory for cached derived arrays
+    """
+
+    def __init__(self, origin, fov, namer, flip=(False, False, False), cache_dir=None):
+        self.origin = origin
+        self.fov = fov
+        self.flip = flip
+        self.namer = namer
+        self.cache_dir = cache_dir
+        self._spaces = {}
+
+    def grid(self, v):
+        return RefGrid(self.origin, self.fov, v, self.flip)
+
+    def space(self, v):
+        """ImageSpace for voxel size v, created once per process"""
+
+        key = '%1.3f' % v
+        if key not in self._spaces:
+            self._spaces[key] = self.grid(v).space()
+        return self._spaces[key]
+
+    def centres(self, v):
+        return self.grid(v).centres(self.cache_dir)
+
+    def path(self, v):
+        """
+        Path of the reference image for v, for use by external tools. The 
+        image is (re)written if it does not exist or does not match the grid.
+        """
+
+        path = self.namer(v)
+        if not (op.isfile(path) and self.grid(v).matches(path)):
+            os.makedirs(op.dirname(path), exist_ok=True)
+            self.grid(v).write(path)
+        return path
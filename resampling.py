@@ -0,0 +1,137 @@
+# In-process resampling of (multi-channel) volumes between axis-aligned
+# voxel grids. Each output voxel is supersampled by the ratio of output to
+# input voxel size (rounded up), the source is trilinearly interpolated at
+# the subvoxel points and the results averaged (ie, trilinear interpolation
+# when resampling to an equal or finer grid). For axis-aligned grids this
+# operation is separable, so it is applied as three sparse 1D operators
+# (one per axis), and the source only needs to be loaded once to produce
+# any number of outputs. The operators themselves are small (a few kB for
+# a whole-brain grid) and quick to build, so are made afresh each time.
+
+import concurrent.futures as cf
+
+import nibabel
+import numpy as np
+from scipy import sparse
+
+
+def _check_aligned(vox2world):
+    rot = vox2world[0:3,0:3]
+    if not np.allclose(rot, np.diag(np.diag(rot))):
+        raise ValueError("Resampling requires axis-aligned voxel grids")
+
+
+def axis_operator(src_scale, src_offset, src_n, ref_scale, ref_offset, ref_n):
+    """
+    Sparse matrix (ref_n x src_n) for one axis, given the scale and offset
+    of the vox2world transform along that axis for source and reference.
+    """
+
+    s = max(1, int(np.ceil(abs(ref_scale / src_scale) - 1e-6)))
+    sub = (np.arange(s) + 0.5) / s - 0.5
+    out = np.repeat(np.arange(ref_n), s)
+    world = ref_scale * (out + np.tile(sub, ref_n)) + ref_offset
+    u = (world - src_offset) / src_scale
+
+    lo = np.floor(u).astype(int)
+    w_hi = u - lo
+    rows = np.concatenate((out, out))
+    cols = np.concatenate((lo, lo + 1))
+    vals = np.concatenate((1 - w_hi, w_hi)) / s
+
+    # Points outside the source take the value 0
+    keep = (cols >= 0) & (cols < src_n)
+    return sparse.csr_matrix((vals[keep], (rows[keep], cols[keep])),
+        shape=(ref_n, src_n))
+
+
+def grid_operators(src_affine, src_shape, ref_affine, ref_shape):
+    """The three 1D operators mapping the source grid onto the reference"""
+
+    _check_aligned(src_affine)
+    _check_aligned(ref_affine)
+    return [ axis_operator(src_affine[a,a], src_affine[a,3], src_shape[a],
+                ref_affine[a,a], ref_affine[a,3], ref_shape[a])
+             for a in range(3) ]
+
+
+def apply_operators(ops, data):
+    """Apply per-axis operators to the first three dimensions of data"""
+
+    out = np.asanyarray(data, dtype=np.float32)
+    for ax, mat in enumerate(ops):
+        out = np.moveaxis(out, ax, 0)
+        shape = out.shape
+        out = (mat @ out.reshape(shape[0], -1)).astype(np.float32)
+        out = np.moveaxis(out.reshape(mat.shape[0], *shape[1:]), 0, ax)
+    return out
+
+
+def _resample_one(data, src_affine, outname, ref):
+
+    # Reference may be an image path or any grid with affine and shape
+    if isinstance(ref, str):
+        refimg = nibabel.load(ref)
+        affine, shape, header = refimg.affine, refimg.shape, refimg.header
+    else:
+        affine, shape, header = ref.affine, ref.shape, None
+
+    ops = grid_operators(src_affine, data.shape, affine, shape)
+    out = apply_operators(ops, data)
+    nii = nibabel.Nifti1Image(out, affine, header)
+    nii.set_data_dtype(np.float32)
+    nibabel.save(nii, outname)
+
+
+def resample_many(src, targets, cores=1):
+    """
+    Resample one source image onto several reference spaces, loading the
+    source only once.
+
+    Args:
+        src: path to source image (3D or 4D)
+        targets: list of (outname, ref) pairs, where ref is a path or a
+            grid object with affine and shape attributes (eg, RefGrid)
+        cores: number of targets to process at once
+    """
+
+    srcimg = nibabel.load(src)
+    data = srcimg.get_fdata(dtype=np.float32)
+
+    with cf.ThreadPoolExecutor(max(1, cores)) as executor:
+        jobs = [ executor.submit(_resample_one, data, srcimg.affine, o, r)
+            for o, r in targets ]
+        for j in jobs:
+            j.result()
+
+
+def resample(src, outname, ref):
+    resample_many(src, [(outname, ref)])
+
+
+def compare(src, ref, other):
+    """
+    Compare resampling src onto ref in-process with other, the same
+    resampling done by another tool (eg, image_scripts.resample), before
+    using one in place of the other.
+
+    Returns:
+        dict of per-channel arrays: 'max' and 'rms' absolute voxel
+        difference, and 'sum' relative difference (%) in channel totals
+    """
+
+    srcimg = nibabel.load(src)
+    refimg = nibabel.load(ref)
+    ops = grid_operators(srcimg.affine, srcimg.shape, refimg.affine, refimg.shape)
+    ours = apply_operators(ops, srcimg.get_fdata(dtype=np.float32))
+    theirs = nibabel.load(other).get_fdata(dtype=np.float32)
+    if ours.shape != theirs.shape:
+        raise ValueError("Shapes differ: %s vs %s" % (ours.shape, theirs.shape))
+
+    ours = ours.reshape(-1, int(np.prod(ours.shape[3:])))
+    theirs = theirs.reshape(ours.shape)
+    d = ours.astype(np.float64) - theirs
+    total = theirs.sum(0, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return { 'max': np.abs(d).max(0), 'rms': np.sqrt(np.mean(d ** 2, axis=0)),
+            'sum': 100 * d.sum(0) / total }
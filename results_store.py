@@ -0,0 +1,142 @@
+# Incrementally written store for analysis results. Each named array has
+# labelled dimensions, split into key dimensions (eg subject x voxel size)
+# and value dimensions (eg method x run x tissue). Each key is stored as
+# its own chunk file, written atomically as soon as it is computed. Any
+# number of processes (or nodes) may therefore write to the store at once,
+# and a crashed run loses only the chunks that were in progress.
+#
+# Alongside its values, each chunk records the size and mtime of the input
+# files it was computed from, so that a rerun only recomputes chunks that
+# are missing or whose inputs have since changed. Dense arrays for export
+# (eg, to the existing .mat layouts) are assembled by gather().
+#
+# Layout on disk:
+#   <directory>/<array>/dims.json     key and value dims, value coordinates
+#   <directory>/<array>/<key>.npz     values and input stamps for one key
+
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+
+def _label(x):
+    # Labels are strings; voxel sizes etc are formatted consistently
+    if isinstance(x, (float, np.floating)):
+        return '%1.2f' % x
+    return str(x)
+
+
+def stamps(paths):
+    """Size and mtime of each input file (None if it does not exist)"""
+
+    out = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            out[op.abspath(p)] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            out[op.abspath(p)] = None
+    return out
+
+
+class ResultsStore(object):
+    """A directory of labelled, chunked result arrays"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _dir(self, name):
+        return op.join(self.directory, name)
+
+    def _chunk(self, name, key):
+        key = key if isinstance(key, (tuple, list)) else (key,)
+        return op.join(self._dir(name), '__'.join(map(_label, key)) + '.npz')
+
+    def define(self, name, keys, dims, coords):
+        """
+        Declare an array (if not already declared).
+
+        Args:
+            name: array name, eg 'sums'
+            keys: names of the key dimensions, eg ('subject', 'vox')
+            dims: names of the value dimensions, eg ('method', 'run', 'tissue')
+            coords: dict of value dimension -> list of labels
+        """
+
+        spec = { 'keys': list(keys), 'dims': list(dims),
+            'coords': { d: list(map(_label, coords[d])) for d in dims } }
+        path = op.join(self._dir(name), 'dims.json')
+        if op.isfile(path):
+            with open(path, 'r') as f:
+                if json.load(f) != spec:
+                    raise RuntimeError("Array %s already defined with different dims" % name)
+            return
+
+        os.makedirs(self._dir(name), exist_ok=True)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(spec, f, indent=1)
+        os.replace(tmp, path)
+
+    def spec(self, name):
+        with open(op.join(self._dir(name), 'dims.json'), 'r') as f:
+            return json.load(f)
+
+    def write(self, name, key, values, inputs=()):
+        """Write the values for one key, with stamps of the input files"""
+
+        spec = self.spec(name)
+        values = np.asarray(values)
+        shape = tuple(len(spec['coords'][d]) for d in spec['dims'])
+        if values.shape != shape:
+            raise ValueError("Values for %s should be sized %s" % (name, shape))
+
+        path = self._chunk(name, key)
+        tmp = path[:-4] + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp, values=values, inputs=json.dumps(stamps(inputs)))
+        os.replace(tmp, path)
+
+    def read(self, name, key):
+        """Values for one key, or None if not (yet) written"""
+
+        try:
+            with np.load(self._chunk(name, key)) as f:
+                return f['values']
+        except FileNotFoundError:
+            return None
+
+    def is_current(self, name, key, inputs=()):
+        """Has key been written, from inputs as they are now?"""
+
+        try:
+            with np.load(self._chunk(name, key)) as f:
+                recorded = json.loads(str(f['inputs']))
+        except FileNotFoundError:
+            return False
+        return recorded == stamps(inputs)
+
+    def keys(self, name):
+        """Keys (as tuples of labels) written so far"""
+
+        return [ tuple(f[:-4].split('__')) for f in sorted(os.listdir(self._dir(name)))
+            if f.endswith('.npz') and '.tmp' not in f ]
+
+    def gather(self, name, labels, fill=0, dtype=np.float32):
+        """
+        Dense array of the values for every combination of key labels,
+        sized (key dims..., value dims...). Missing keys take fill.
+
+        Args:
+            labels: list of labels for each key dimension, in order
+        """
+
+        spec = self.spec(name)
+        shape = tuple(len(spec['coords'][d]) for d in spec['dims'])
+        out = np.full(tuple(len(l) for l in labels) + shape, fill, dtype=dtype)
+        for idx in np.ndindex(*out.shape[0:len(labels)]):
+            values = self.read(name, tuple(l[i] for l, i in zip(labels, idx)))
+            if values is not None:
+                out[idx] = values
+        return out
@@ -0,0 +1,172 @@
+# Numerical ground truth PVs for the simulated bumpy sphere surfaces.
+# This is a vectorised port of voxelIntegrator.m / bumpySphereClassifier.m:
+# each voxel is supersampled on a regular grid of points and the fraction
+# of points carrying each tissue label gives the PVs [GM, WM, CSF].
+#
+# Voxels that the bumpy sphere boundaries cannot pass through (decided from
+# the range of radii that a voxel spans) are filled in a single step; only
+# the remaining boundary voxels are supersampled, in chunked batches that
+# are spread across processes.
+
+import functools
+import multiprocessing
+import os.path as op
+
+import nibabel
+import numpy as np
+
+# Radius of the inner surface and ratio of outer to inner (matlab_scripts.m)
+BUMPY_DS = (60, 1.05)
+
+# Upper limit on the number of supersample points held in memory per batch
+CHUNK_POINTS = 2 ** 22
+
+# Tissue labels, as per bumpySphereClassifier.m
+GM, WM, CSF = 1, 2, 3
+
+
+def bumpy_sphere_function(d1, d2, X, Y, Z):
+    """Radii of the inner and outer surfaces in the direction of each point"""
+
+    # Spherical polars, as per MATLAB's cart2sph
+    theta = np.arctan2(Y, X)
+    phi = np.arctan2(Z, np.sqrt(X**2 + Y**2))
+
+    u = 5
+    lim = np.pi/2 * ((u-1) / u)
+    tomodify = (np.abs(phi) < lim)
+    s1 = np.sin(u * (phi - theta)) ** 20
+    s2 = np.sin(u * (phi + theta)) ** 20
+
+    r_in = d1 * (1 - 0.1 * np.maximum(s1, s2))
+    r_in[~tomodify] = d1
+    r_out = d2 * r_in
+
+    return r_in, r_out
+
+
+def bumpy_sphere_classifier(d1, d2, X, Y, Z):
+    """Label points as GM (1), WM (2) or CSF (3)"""
+
+    r = np.sqrt(X**2 + Y**2 + Z**2)
+    r_in, r_out = bumpy_sphere_function(d1, d2, X, Y, Z)
+
+    labels = np.full(r.shape, GM, dtype=np.int8)
+    labels[r < r_in] = WM
+    labels[r >= r_out] = CSF
+    return labels
+
+
+def supersample_factor(v):
+    """Supersampling factor used by matlab_scripts.m for voxel size v"""
+
+    # MATLAB's round() takes halves away from zero, unlike np.round
+    return 2 * int(np.floor(15 * v / 2 + 0.5)) + 1
+
+
+def radius_bounds(vox2world, ijk):
+    """Min and max distance from the origin of the points within each voxel"""
+
+    # Voxel corners in world space (8 per voxel). The extremes of the
+    # radius over an axis-aligned box lie at its corners (max) or at the
+    # clamped projection of the origin onto the box (min).
+    offsets = np.array(np.meshgrid([-0.5, 0.5], [-0.5, 0.5], [-0.5, 0.5],
+        indexing='ij')).reshape(3, -1).T
+    corners = ijk[:,None,:] + offsets[None,:,:]
+    corners = corners @ vox2world[0:3,0:3].T + vox2world[0:3,3]
+    lo = corners.min(1)
+    hi = corners.max(1)
+
+    nearest = np.clip(0, lo, hi)
+    rmin = np.linalg.norm(nearest, axis=1)
+    rmax = np.linalg.norm(corners, axis=2).max(1)
+    return rmin, rmax
+
+
+def classify_voxels(vox2world, ijk, d1, d2):
+    """
+    Decide which voxels lie wholly within one tissue. Returns an array of
+    labels, with 0 marking voxels that the boundaries may cross.
+    """
+
+    # The inner surface lies between 0.9 d1 and d1, the outer surface
+    # between 0.9 d1 d2 and d1 d2.
+    rmin, rmax = radius_bounds(vox2world, ijk)
+    labels = np.zeros(ijk.shape[0], dtype=np.int8)
+    labels[rmax < 0.9 * d1] = WM
+    labels[(rmin >= d1) & (rmax < 0.9 * d1 * d2)] = GM
+    labels[rmin >= d1 * d2] = CSF
+    return labels
+
+
+def _integrate_chunk(vox2world, supersample, d1, d2, ijk):
+    """Supersampled PVs for a batch of voxels (voxelIntegrator.m)"""
+
+    s = ((np.arange(supersample) + 0.5) / supersample) - 0.5
+    sub = np.array(np.meshgrid(s, s, s, indexing='ij')).reshape(3, -1).T
+    points = ijk[:,None,:] + sub[None,:,:]
+    points = points @ vox2world[0:3,0:3].T + vox2world[0:3,3]
+
+    labels = bumpy_sphere_classifier(d1, d2,
+        points[...,0], points[...,1], points[...,2])
+    pvs = np.stack([ (labels == l).sum(1) for l in (GM, WM, CSF) ], axis=1)
+    return pvs / sub.shape[0]
+
+
+def integrate(ref, supersample, d1=BUMPY_DS[0], d2=BUMPY_DS[1], cores=1):
+    """
+    Ground truth PVs for the bumpy sphere within a reference space.
+
+    Args:
+        ref: path to the reference image defining the voxel grid
+        supersample: number of points per voxel side
+        d1, d2: bumpy sphere parameters
+        cores: number of processes used for the boundary voxels
+
+    Returns:
+        array sized (X, Y, Z, 3) of PVs in the order GM, WM, CSF
+    """
+
+    refimg = nibabel.load(ref)
+    vox2world = refimg.affine
+    size = refimg.header['dim'][1:4]
+    ijk = np.indices(size).reshape(3, -1).T
+
+    pvs = np.zeros((ijk.shape[0], 3), dtype=np.float32)
+    labels = classify_voxels(vox2world, ijk, d1, d2)
+    for col, l in enumerate((GM, WM, CSF)):
+        pvs[labels == l, col] = 1
+
+    # Only the boundary voxels need to be supersampled
+    boundary = np.flatnonzero(labels == 0)
+    per_chunk = max(1, CHUNK_POINTS // (supersample ** 3))
+    chunks = [ ijk[boundary[c:c+per_chunk]]
+        for c in range(0, boundary.size, per_chunk) ]
+    worker = functools.partial(_integrate_chunk, vox2world, supersample, d1, d2)
+
+    if cores == 1:
+        results = map(worker, chunks)
+    else:
+        with multiprocessing.Pool(cores) as p:
+            results = p.map(worker, chunks)
+
+    for c, r in zip(range(0, boundary.size, per_chunk), results):
+        pvs[boundary[c:c+per_chunk],:] = r
+
+    return pvs.reshape(*size, 3)
+
+
+def save_truth(ref, pvs, outname):
+    """Save PVs onto a copy of the reference header (as save_nii in MATLAB)"""
+
+    refimg = nibabel.load(ref)
+    nii = nibabel.Nifti1Image(pvs, refimg.affine, refimg.header)
+    nibabel.save(nii, outname)
+
+
+def make_truth(ref, outname, v, cores=1):
+    """Produce the tru_%1.2f.nii ground truth for voxel size v"""
+
+    if not op.isfile(outname):
+        pvs = integrate(ref, supersample_factor(v), cores=cores)
+        save_truth(ref, pvs, outname)
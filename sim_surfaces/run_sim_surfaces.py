@@ -10,7 +10,9 @@
 # This script requires that the HCP's wb_command be installed 
 
 import sys 
+import os
 import os.path as op
+import json
 import numpy as np
 import nibabel
 import scipy.io
@@ -19,11 +21,37 @@ import subprocess
 
 sys.path.append('..')
 import image_scripts
-from image_scripts import masked_vox_diff
+import nifti_cache
+from manifest import Manifest, file_hash
+import resampling
+import ground_truth
+import label_cache
+import rc_method
+from results_store import ResultsStore
+import slab_metrics
 
 VOXSIZES = np.arange(1, 3.2, 0.2)
 ROOT = '/mnt/hgfs/Data/toblerone_evaluation_data/sim_surfaces/surf'
 
+# Derive the ground truth at every voxel size from a single high resolution
+# label cache, rather than integrating afresh for each. Every sim metric is
+# scored against the truth, and the two differ per voxel by up to ~0.006,
+# so this stays off until the tru_ volumes have been regenerated this way
+# and compared against the integrator's
+TRUTH_FROM_CACHE = False
+
+# Resample in-process (resampling.resample_many, one pass per source) rather
+# than with image_scripts.resample, which produced the published resampling
+# and RC2/Neuro2 results. The two are different methods: check that they
+# agree on these images with resampling.compare before switching. Each
+# output records which was used, and is remade if this changes
+RESAMPLE_IN_PROCESS = False
+
+# RC's estimates via rc_method rather than RCmethod.m (from the MATLAB 
+# script). Leave off until 'run_HCP.py check-rc' has passed for the current
+# rc_method, which it shares with the HCP RC results
+RC_NATIVE = False
+
 def refname(v):
     return op.join(ROOT, 'ref_{:1.2f}.nii'.format(v))
 
@@ -35,14 +63,151 @@ def make_refs():
 
     orig = np.array([-75, -75, -75])
     FoV = np.array([150, 150, 150])
+    manifest = Manifest(ROOT)
     for v in VOXSIZES:
         ref = refname(v)
-        if not op.isfile(ref):
+        params = { 'orig': orig.tolist(), 'FoV': FoV.tolist(), 'vox': v }
+        if not manifest.is_current(ref, params=params):
             image_scripts.make_reference(orig, FoV, v, ref)
+            manifest.record(ref, params=params)
+
+def cachename():
+    return op.join(ROOT, 'bumpy_labels.npz')
+
+def make_truths(cores=8):
+    """Produce the ground truth PVs within each reference space"""
+
+    if TRUTH_FROM_CACHE:
+        todo = [ v for v in VOXSIZES if not op.isfile(truname(v)) ]
+        if todo:
+            if not op.isfile(cachename()):
+                label_cache.build_cache(cachename(), cores=cores)
+            cache = label_cache.load_cache(cachename())
+
+        for v in todo:
+            pvs = label_cache.aggregate(cache, refname(v))
+            ground_truth.save_truth(refname(v), pvs, truname(v))
+
+    else: 
+        for v in VOXSIZES:
+            ground_truth.make_truth(refname(v), truname(v), v, cores)
 
-def summer(a, v):
-    return np.sum(a[:,0:2], axis=0) * (v ** 3)
-            
+def rcname(v):
+    return op.join(ROOT, 'rc_{:1.2f}.nii'.format(v))
+
+def make_rc(cores=8):
+    """
+    RC PVs within each reference space via rc_method, if RC_NATIVE. This 
+    uses the same GIFTI white, pial and mid surfaces that the MATLAB script
+    passes to RCmethod.m; until it has written them, this does nothing (and
+    MATLAB produces RC's estimates itself)
+    """
+
+    if not RC_NATIVE: 
+        return 
+
+    surfdir = op.join(ROOT, 'surf')
+    LWS, LPS, LMS = [ op.join(surfdir, '%s.surf.gii' % s) for s in ('white', 'pial', 'mid') ]
+    if not all(op.isfile(s) for s in (LWS, LPS, LMS)):
+        return 
+
+    for v in VOXSIZES:
+        if not op.isfile(rcname(v)):
+            rc_method.rc_method(refname(v), rcname(v), LWS=LWS, LPS=LPS, LMS=LMS, cores=cores)
+
+def resample_missing(src, targets, cores=4):
+    """
+    Resample src onto each (outname, ref) target that is missing, or was 
+    made from a different src or by the other resampler 
+    """
+
+    manifest = Manifest(ROOT)
+    params = { 'resampler': 'resampling' if RESAMPLE_IN_PROCESS else 'image_scripts' }
+    targets = [ (o, r) for (o, r) in targets 
+        if not manifest.is_current(o, [src, r], params) ]
+
+    if RESAMPLE_IN_PROCESS and targets: 
+        resampling.resample_many(src, targets, cores)
+    elif targets: 
+        for o, r in targets: 
+            image_scripts.resample(src, o, r)
+
+    for o, r in targets: 
+        manifest.record(o, [src, r], params)
+
+def results_store():
+    """
+    Store of results at each voxel size, written as each is computed and
+    exported to sim_surface_data.mat at the end
+    """
+
+    store = ResultsStore(op.join(ROOT, 'results'))
+    tissues = ['GM', 'WM']
+    store.define('sums', ('vox',), ('method', 'tissue'), 
+        { 'method': ['tob', 'rc', 'rc2', 'neuro', 'neuro2', 'tru'], 'tissue': tissues })
+    store.define('voxs', ('vox',), ('method', 'tissue'), 
+        { 'method': ['tob', 'rc', 'rc2', 'neuro', 'neuro2'], 'tissue': tissues })
+    store.define('resamp', ('vox',), ('from_vox', 'tissue'), 
+        { 'from_vox': VOXSIZES, 'tissue': tissues })
+    return store 
+
+def export_results(store):
+    """Arrays in the layout of sim_surface_data.mat (missing results are zero)"""
+
+    gather = lambda name: store.gather(name, [VOXSIZES], dtype=np.float64)
+
+    # resamp is stored by the voxel size resampled to, but saved by the 
+    # voxel size resampled from first 
+    return { 
+        'resamp': np.swapaxes(gather('resamp'), 0, 1), 
+        'voxs': gather('voxs'), 
+        'sums': gather('sums'),
+        }
+
+def vox_metric_path():
+    return op.join(ROOT, 'vox_metric.json')
+
+def vox_metric(v=VOXSIZES[0]):
+    """
+    The slab_metrics error, and its scale, that reproduces masked_vox_diff
+    (which gave the voxs and resamp results before slab_metrics), so that
+    results stay comparable with earlier runs. This is found by comparing 
+    both errors against masked_vox_diff(tru, tob) at voxel size v, and is
+    recorded in ROOT (and found again if image_scripts changes). 
+
+    Returns: 
+        (name, scale), name being 'mae' or 'rms' 
+    """
+
+    try: 
+        with open(vox_metric_path(), 'r') as f: 
+            record = json.load(f)
+        if record['image_scripts'] == file_hash(image_scripts.__file__): 
+            return record['metric'], record['scale']
+    except (FileNotFoundError, ValueError): 
+        pass 
+
+    paths = { 'tru': truname(v), 'tob': op.join(ROOT, 'tob_%1.2f.nii' % v) }
+    loader = lambda path: nifti_cache.load(path).reshape(-1,3)
+    tru, tob = loader(paths['tru']), loader(paths['tob'])
+    fltr = slab_metrics.boundary_mask(tru)
+    ref = np.asarray(image_scripts.masked_vox_diff(tru, tob, fltr), dtype=np.float64)
+
+    metrics = slab_metrics.compare(paths, [('tru', 'tob')], mask=slab_metrics.boundary_mask)
+    found = [ (name, scale) for name in ('mae', 'rms') for scale in (1, 100) 
+        if np.allclose(scale * metrics[name]['tru','tob'], ref, rtol=1e-4, atol=1e-8) ]
+    if not found: 
+        raise RuntimeError("Neither MAE %s nor RMS %s matches masked_vox_diff %s" 
+            % (metrics['mae']['tru','tob'], metrics['rms']['tru','tob'], ref))
+
+    name, scale = found[0]
+    tmp = vox_metric_path() + '.tmp'
+    with open(tmp, 'w') as f: 
+        json.dump({ 'metric': name, 'scale': scale, 'vox': float(v), 
+            'image_scripts': file_hash(image_scripts.__file__), 
+            'masked_vox_diff': ref.tolist() }, f, indent=1)
+    os.replace(tmp, vox_metric_path())
+    return name, scale
 
 def main(root):
     
@@ -51,7 +216,14 @@ def main(root):
     # All methods require the reference spaces to be created first
     make_refs()
 
-    # Call the MATLAB script to calculate ground truth, RC and Neuropoly results 
+    # Ground truth via numerical integration. The MATLAB script skips this
+    # step for any tru_ file that already exists
+    make_truths()
+
+    # RC in Python. The MATLAB script skips any rc_ file that already exists
+    make_rc()
+
+    # Call the MATLAB script to calculate RC and Neuropoly results
     # (this last method is sloooooooooow)
     matpath = "/opt/Matlab/R2017a/bin/matlab"
     if not op.isfile(matpath):
@@ -73,84 +245,85 @@ def main(root):
             out, _, _= toblerone.estimate_cortex(LWS=LWS, LPS=LPS, ref=ref, struct2ref='I', cores=4)
             refSpace.saveImage(out, outname)
 
+        # Resample the ground truth onto every coarser grid 
         base = op.join(ROOT, 'tru_{:1.2f}.nii'.format(v))
-        for v2 in VOXSIZES[vidx+1:]:
-            ref2 = refname(v2)
-            out2name = op.join(ROOT, 'tru_{:1.2f}_resamp_{:1.2f}.nii.gz'.format(v, v2))
-            if not op.isfile(out2name):
-                image_scripts.resample(base, out2name, ref2)
+        targets = [ (op.join(ROOT, 'tru_{:1.2f}_resamp_{:1.2f}.nii.gz'.format(v, v2)), 
+            refname(v2)) for v2 in VOXSIZES[vidx+1:] ]
+        resample_missing(base, targets)
 
 
     # And resampling for the RC2 and Neuro2 methods: 
     rcbase = op.join(ROOT, 'rc_1.00.nii')
     neurobase = op.join(ROOT, 'neuro1_1.00.nii')
-    for v in VOXSIZES[1:]:
-        ref = refname(v)
-        rc2 = op.join(ROOT, 'rc_2_%1.2f.nii.gz' % v)
-        neuro2 = op.join(ROOT, 'neuro_2_%1.2f.nii.gz' % v)
-        if not op.isfile(rc2):
-            image_scripts.resample(rcbase, rc2, ref)
-        if not op.isfile(neuro2):
-            image_scripts.resample(neurobase, neuro2, ref)
+    resample_missing(rcbase, 
+        [ (op.join(ROOT, 'rc_2_%1.2f.nii.gz' % v), refname(v)) for v in VOXSIZES[1:] ])
+    resample_missing(neurobase, 
+        [ (op.join(ROOT, 'neuro_2_%1.2f.nii.gz' % v), refname(v)) for v in VOXSIZES[1:] ])
 
 
     # Analysis below 
-    loader = lambda path: nibabel.load(path).get_fdata().reshape(-1,3)
-
-    # Output arrays and their dimensions (tissues is always [GM, WM]): 
+    # Output arrays and their dimensions (tissues is always [GM, WM]), 
+    # stored per voxel size: 
     # Voxel-wise errors, dims: voxels x methods x tissues 
-    voxs = np.zeros((VOXSIZES.size, 5, 2))
-
     # Total tissue volumes, dims: voxels x methods x tissues 
-    sums = np.zeros((VOXSIZES.size, 6, 2))
-
-    # Voxel-wise error between native and resampled Toblerone, dims: voxels x tissues
-    resamp = np.zeros((VOXSIZES.size, VOXSIZES.size, 2))
+    # Voxel-wise error between native and resampled truth, dims: voxels x voxels x tissues
+    store = results_store()
+    metric, scale = vox_metric()
 
     for vidx, v in enumerate(VOXSIZES): 
 
-        tob = loader(op.join(ROOT, 'tob_%1.2f.nii' % v))
-        tru = loader(op.join(ROOT, 'tru_%1.2f.nii' % v))
-        rc = loader(op.join(ROOT, 'rc_%1.2f.nii' % v))
-        neuro = loader(op.join(ROOT, 'neuro1_%1.2f.nii' % v))
+        inputs = [ op.join(ROOT, f % v) for f in ('tob_%1.2f.nii', 'tru_%1.2f.nii', 
+            'rc_%1.2f.nii', 'neuro1_%1.2f.nii') ]
         if vidx > 0: 
-            rc2 = loader(op.join(ROOT, 'rc_2_%1.2f.nii.gz' % v))
-            neuro2 = loader(op.join(ROOT, 'neuro_2_%1.2f.nii.gz' % v))
-
-        # Total tissue volumes 
-        sums[vidx,5,:] = summer(tru,v)
-        sums[vidx,0,:] = summer(tob,v)
-        sums[vidx,1,:] = summer(rc,v)
-        sums[vidx,3,:] = summer(neuro,v)
+            inputs += [ op.join(ROOT, f % v) for f in ('rc_2_%1.2f.nii.gz', 'neuro_2_%1.2f.nii.gz') ]
+        inputs += [ op.join(ROOT, 'tru_{:1.2f}_resamp_{:1.2f}.nii.gz'.format(v2, v)) 
+            for v2 in VOXSIZES[:vidx] ]
+        inputs.append(vox_metric_path())
+        if all( store.is_current(n, v, inputs) for n in ('sums', 'voxs', 'resamp') ):
+            continue 
+
+        voxs = np.zeros((5, 2))
+        sums = np.zeros((6, 2))
+        resamp = np.zeros((VOXSIZES.size, 2))
+
+        # Every image at this voxel size is compared against the truth in a 
+        # single pass over z-slabs, rather than loading each whole volume
+        paths = { 'tru': op.join(ROOT, 'tru_%1.2f.nii' % v),
+                  'tob': op.join(ROOT, 'tob_%1.2f.nii' % v),
+                  'rc': op.join(ROOT, 'rc_%1.2f.nii' % v),
+                  'neuro': op.join(ROOT, 'neuro1_%1.2f.nii' % v) }
         if vidx > 0: 
-            sums[vidx,2,:] = summer(rc2,v)
-            sums[vidx,4,:] = summer(neuro2,v)
-
-        # Filter to just voxels containing (GM & WM) or (GM & CSF)
-        # ie, excluding those wholly within the cortex
-        fltr = np.logical_or(
-            ((tru[:,0] > 0) & (tru[:,1] > 0)), 
-            ((tru[:,0] > 0) & (tru[:,2] > 0))
-        )
-
-        # Mean of abs voxel-wise differences in each tissue 
-        voxs[vidx, 0] = masked_vox_diff(tru, tob, fltr)
-        voxs[vidx, 1] = masked_vox_diff(tru, rc, fltr)
-        voxs[vidx, 3] = masked_vox_diff(tru, neuro, fltr)
-        if vidx > 0: 
-            voxs[vidx, 2] = masked_vox_diff(tru, rc2, fltr)
-            voxs[vidx, 4] = masked_vox_diff(tru, neuro2, fltr)
-
-
-        # Resampling methods  
+            paths['rc2'] = op.join(ROOT, 'rc_2_%1.2f.nii.gz' % v)
+            paths['neuro2'] = op.join(ROOT, 'neuro_2_%1.2f.nii.gz' % v)
         for v2idx, v2 in enumerate(VOXSIZES[:vidx]):
-            tru2 = loader(op.join(
-                ROOT, 'tru_{:1.2f}_resamp_{:1.2f}.nii.gz'.format(v2, v)))
-            resamp[v2idx,vidx,:] = masked_vox_diff(tru, tru2, fltr)
+            paths['tru2_%d' % v2idx] = op.join(
+                ROOT, 'tru_{:1.2f}_resamp_{:1.2f}.nii.gz'.format(v2, v))
+
+        # Errors are taken over voxels containing (GM & WM) or (GM & CSF)
+        # in the truth, ie, excluding those wholly within the cortex
+        metrics = slab_metrics.compare(paths, 
+            [ ('tru', n) for n in paths if n != 'tru' ], 
+            mask=slab_metrics.boundary_mask)
+
+        # Total tissue volumes, and voxel-wise differences in each tissue 
+        # over the mask, as whichever of the MAE and RMS masked_vox_diff 
+        # gave (see vox_metric) 
+        methods = ['tob', 'rc', 'rc2', 'neuro', 'neuro2']
+        sums[5,:] = metrics['sums']['tru'] * (v ** 3)
+        for midx, m in enumerate(methods): 
+            if m in paths: 
+                sums[midx,:] = metrics['sums'][m] * (v ** 3)
+                voxs[midx,:] = scale * metrics[metric]['tru', m]
+
+        # Resampling methods, likewise 
+        for v2idx, v2 in enumerate(VOXSIZES[:vidx]):
+            resamp[v2idx,:] = scale * metrics[metric]['tru', 'tru2_%d' % v2idx]
+
+        store.write('resamp', v, resamp, inputs)
+        store.write('voxs', v, voxs, inputs)
+        store.write('sums', v, sums, inputs)
 
-    scipy.io.savemat('sim_surface_data.mat', {
-        'resamp': resamp, 'voxs': voxs, 'sums': sums
-        })
+    scipy.io.savemat('sim_surface_data.mat', export_results(store))
 
 
 if __name__ == "__main__":
@@ -4,14 +4,24 @@ Draw graphs for the Toblerone paper from the simulated cortical surface
 dataset
 """
 
+import sys
 import scipy.io as sio 
 import numpy as np 
 import matplotlib.pyplot as plt 
 import os 
 import os.path as op 
+
+sys.path.append('..')
+from figure_cache import Figure, build
+
 savekws = {'dpi': 400, 'bbox_inches': 'tight'}
 cmap = np.array(plt.get_cmap('tab10').colors)
 
+# Each figure is added to FIGURES, and built (or skipped, if unchanged since 
+# last time) in the last cell. Set REBUILD to redraw every figure regardless.
+FIGURES = []
+REBUILD = False
+
 
 #%% Load in the data, set some handy constants 
 
@@ -30,75 +40,87 @@ start_idx = [0, 0, 1, 0, 1, 1]
 truth = sums[0,-1,:]
 sum_errs = 100 * (sums[:,:,:] - truth[None,None,:]) / truth[None,None,:]
 
-for exclude,lims,suff in zip([['Neuro'], []], [(-0.08, 0.1), (-3, 1.5)], ['', '_full']):
-    fig = plt.figure()
+# Passed to each plotting function, so that a figure is redrawn if any of 
+# these change 
+STYLE = dict(voxsteps=VOXSTEPS, methods=all_methods, start_idx=start_idx, 
+    colors=cmap, tissues=TISSUES)
+
+def plot_sum_errs(fig, sum_errs, exclude, lims, voxsteps, methods, start_idx, 
+                  colors, tissues):
     fig.set_size_inches(7,3.5)
-    axes = [ plt.subplot(1,2,i) for i in range(1,3) ]
-    min_max = np.zeros((0,2))
+    axes = [ fig.add_subplot(1,2,i) for i in range(1,3) ]
 
     for tiss,ax in enumerate(axes):
-        for midx,meth in enumerate(all_methods): 
+        for midx,meth in enumerate(methods): 
             if meth not in exclude: 
                 to_plot = sum_errs[start_idx[midx]:,midx,tiss]
-                min_max = np.vstack((min_max, [to_plot.min(), to_plot.max()]))
-                ax.plot(VOXSTEPS[start_idx[midx]:], to_plot, label=meth, color=cmap[midx,:])
+                ax.plot(voxsteps[start_idx[midx]:], to_plot, label=meth, color=colors[midx,:])
 
-        ax.plot(VOXSTEPS[1:], sum_errs[1:,-1,tiss], label='Num. sln.', color=cmap[5,:])
-        ax.set_title('Error in total %s volume' % TISSUES[tiss])
-        ax.set_xticks(VOXSTEPS)
+        ax.plot(voxsteps[1:], sum_errs[1:,-1,tiss], label='Num. sln.', color=colors[5,:])
+        ax.set_title('Error in total %s volume' % tissues[tiss])
+        ax.set_xticks(voxsteps)
         ax.tick_params(axis='x', labelrotation=90)
         ax.set_xlabel('Voxel size (mm)')
         ax.set_ylim(lims)
 
     axes[0].legend(ncol=2)
     axes[0].set_ylabel('Error (%)')
-    plt.savefig('figs/sim_sum%s.png' % suff, **savekws)
+
+for exclude,lims,suff in zip([['Neuro'], []], [(-0.08, 0.1), (-3, 1.5)], ['', '_full']):
+    FIGURES.append(Figure('figs/sim_sum%s.png' % suff, plot_sum_errs, 
+        sum_errs, exclude=exclude, lims=lims, **STYLE))
 
 
 #%% Voxel-wise error at each resolution 
 # We use the numerical solution at each voxel size as reference 
 
-for exclude,lims,suff in zip([['Neuro'], []], [15, 21], ['', '_full']):
-    fig = plt.figure()
+def plot_vox_errs(fig, voxs, exclude, lims, voxsteps, methods, start_idx, 
+                  colors, tissues):
     fig.set_size_inches(7,3.5)
-    axes = [ plt.subplot(1,2,i) for i in range(1,3) ]
-    min_max = np.zeros((0,2))
+    axes = [ fig.add_subplot(1,2,i) for i in range(1,3) ]
 
     for tiss,ax in enumerate(axes):
-        for midx,meth in enumerate(all_methods): 
+        for midx,meth in enumerate(methods): 
             if meth not in exclude: 
                 to_plot = voxs[start_idx[midx]:,midx,tiss]
-                min_max = np.vstack((min_max, [to_plot.min(), to_plot.max()]))
-                ax.plot(VOXSTEPS[start_idx[midx]:], to_plot, label=meth, color=cmap[midx,:])
+                ax.plot(voxsteps[start_idx[midx]:], to_plot, label=meth, color=colors[midx,:])
 
-        ax.set_title('Per-voxel error in %s' % TISSUES[tiss])
-        ax.set_xticks(VOXSTEPS)
+        ax.set_title('Per-voxel error in %s' % tissues[tiss])
+        ax.set_xticks(voxsteps)
         ax.tick_params(axis='x', labelrotation=90)        
         ax.set_xlabel('Voxel size (mm)')
         ax.set_ylim(0,lims)
 
     axes[1].legend(ncol=2)
     axes[0].set_ylabel('RMS voxel error (%)')
-    plt.savefig('figs/sim_rms%s.png' % suff, **savekws)
+
+for exclude,lims,suff in zip([['Neuro'], []], [15, 21], ['', '_full']):
+    FIGURES.append(Figure('figs/sim_rms%s.png' % suff, plot_vox_errs, 
+        voxs, exclude=exclude, lims=lims, **STYLE))
 
 
 #%% Error of resampling ground truth to other resolutions 
 
-fig = plt.figure()
-fig.set_size_inches(6,4)
-axes = plt.subplot(1,1,1)
-axes.hold = True 
+def plot_resamp(fig, resamp, voxsteps):
+    fig.set_size_inches(6,4)
+    axes = fig.add_subplot(1,1,1)
+
+    for vidx in range(resamp.shape[1] - 2):
+        axes.plot(voxsteps[vidx+1:], resamp[vidx,vidx+1:,0], 
+        label=('%1.1f' % voxsteps[vidx]))
+
+    axes.legend(loc='center left', bbox_to_anchor=(1, 0.5),
+        fancybox=True, ncol=1, title='Input voxel \n size (mm)')
+    axes.set_xticks(voxsteps[1:])
+    axes.set_xlim(1.1, 3.1)
+    axes.set_xlabel('Output voxel size (mm)')
+    axes.set_ylabel('RMS voxel error (%)')
+    axes.set_title('Error of resampling ground truth (GM)')
+
+FIGURES.append(Figure('figs/sim_resamp.png', plot_resamp, resamp, voxsteps=VOXSTEPS))
 
 
-for vidx in range(resamp.shape[1] - 2):
-    axes.plot(VOXSTEPS[vidx+1:], resamp[vidx,vidx+1:,0], 
-    label=('%1.1f' % VOXSTEPS[vidx]))
+#%% Render whichever figures have changed, in parallel
 
-axes.legend(loc='center left', bbox_to_anchor=(1, 0.5),
-    fancybox=True, ncol=1, title='Input voxel \n size (mm)')
-plt.xticks(VOXSTEPS[1:])
-plt.xlim(1.1, 3.1)
-plt.xlabel('Output voxel size (mm)')
-plt.ylabel('RMS voxel error (%)')
-plt.title('Error of resampling ground truth (GM)')
-plt.savefig('figs/sim_resamp.png', **savekws)
+if __name__ == '__main__':
+    build(FIGURES, savekws, force=REBUILD)
@@ -0,0 +1,100 @@
+# Voxel-wise comparison of PV maps, computed slab by slab. Rather than
+# loading every method's PV map as a whole volume, each image is opened as
+# a nibabel proxy and read in float32 slabs along z. For each slab, the
+# tissue sums of every image and the masked squared and absolute errors of
+# every pair of images are accumulated, so that all of the metrics for a set of methods
+# come from one pass over the data. Peak memory is then a few slabs,
+# regardless of the size of the grid or the number of methods.
+#
+# Sums and errors are accumulated in float64, so results match the same
+# calculation on whole volumes to within float32 rounding of the inputs.
+
+import nibabel
+import numpy as np
+
+# Target bytes of image data (summed over all images) held per slab
+SLAB_BYTES = 256 * (2 ** 20)
+
+
+def boundary_mask(pvs):
+    """
+    Voxels containing (GM & WM) or (GM & CSF), ie, excluding those wholly
+    within one tissue. pvs is sized (..., 3), GM/WM/CSF in the last dim.
+    """
+
+    gm = pvs[...,0] > 0
+    return (gm & (pvs[...,1] > 0)) | (gm & (pvs[...,2] > 0))
+
+
+def slab_size(shape, n_images, budget=None):
+    """Number of z-slices per slab to keep n_images within budget bytes"""
+
+    per_slice = int(np.prod(shape[0:2])) * int(np.prod(shape[3:])) * 4 * n_images
+    return int(np.clip((budget or SLAB_BYTES) // max(per_slice, 1), 1, shape[2]))
+
+
+def compare(paths, pairs, mask=boundary_mask, tissues=2, budget=None):
+    """
+    Tissue sums of each image, and masked RMS and mean absolute errors 
+    between pairs of images, in one pass over z-slabs. All images must
+    share the same grid.
+
+    Args:
+        paths: dict of name -> path to a 4D PV map (GM/WM/CSF)
+        pairs: list of (reference, other) names to compare
+        mask: function of the reference's PVs (..., 3) giving the voxels
+            over which errors are taken, default boundary_mask
+        tissues: number of leading tissues to report (default GM, WM)
+        budget: bytes of image data per slab, default SLAB_BYTES
+
+    Returns:
+        dict with keys 'sums' (name -> sum of each tissue over the whole
+        volume), 'rms' and 'mae' ((ref, other) -> RMS and mean absolute
+        error in each tissue over the mask) and 'count' ((ref, other) -> 
+        number of voxels in mask).
+        Errors are NaN where the mask is empty.
+    """
+
+    # keep_file_open, so that consecutive slabs of a gzipped image follow
+    # on from one another rather than decompressing from the start each time
+    imgs = { n: nibabel.load(p, keep_file_open=True) for n, p in paths.items() }
+    shape = next(iter(imgs.values())).shape
+    for n, img in imgs.items():
+        if img.ndim != 4 or img.shape[0:3] != shape[0:3]:
+            raise ValueError("Image %s is not a PV map on the same grid (%s vs %s)"
+                % (n, img.shape, shape))
+
+    pairs = [ tuple(p) for p in pairs ]
+    sums = { n: np.zeros(tissues) for n in imgs }
+    sq = { p: np.zeros(tissues) for p in pairs }
+    ab = { p: np.zeros(tissues) for p in pairs }
+    count = { p: 0 for p in pairs }
+
+    step = slab_size(shape, len(imgs), budget)
+    for z0 in range(0, shape[2], step):
+        z1 = min(z0 + step, shape[2])
+        slab = { n: np.asarray(img.dataobj[:,:,z0:z1,:], dtype=np.float32)
+            for n, img in imgs.items() }
+
+        for n, data in slab.items():
+            sums[n] += data[...,0:tissues].sum((0, 1, 2), dtype=np.float64)
+
+        masks = {}
+        for ref, other in pairs:
+            if ref not in masks:
+                masks[ref] = mask(slab[ref])
+            m = masks[ref]
+            d = slab[ref][m,0:tissues] - slab[other][m,0:tissues]
+            sq[ref, other] += np.sum(np.square(d, dtype=np.float64), axis=0)
+            ab[ref, other] += np.sum(np.abs(d), axis=0, dtype=np.float64)
+            count[ref, other] += int(d.shape[0])
+
+        del slab, masks
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'sums': sums,
+            'rms': { p: np.sqrt(sq[p] / count[p]) for p in pairs },
+            'mae': { p: ab[p] / count[p] for p in pairs },
+            'count': count,
+        }
@@ -0,0 +1,184 @@
+# Sparse, mask-indexed storage for PV maps. Most voxels of a PV map are
+# either empty (outside the brain mask) or pure CSF, so only the voxels
+# that differ from a single fill value are stored: their flat (C-order)
+# voxel indices, and their PVs packed as float32 in fixed-size chunks.
+#
+# A map is stored as a directory (conventionally named *.spv) containing:
+#   index.json      shape, affine, fill value, number of stored voxels and
+#                   the voxel range of each chunk (human readable)
+#   indices.npy     sorted flat indices of the stored voxels
+#   values_*.npy    PVs of the stored voxels, one file per chunk
+#
+# All arrays are memory-mapped on load, so a reader touches only the chunks
+# holding the voxels it asks for.
+
+import json
+import os
+import os.path as op
+import shutil
+
+import nibabel
+import numpy as np
+
+# Stored voxels per values chunk
+CHUNK = 2 ** 18
+
+FORMAT = 'sparse_pv'
+VERSION = 1
+
+
+def _choose_fill(flat):
+    # Either empty voxels or pure voxels of the last class (CSF), whichever
+    # is more common
+    empty = np.zeros(flat.shape[1], dtype=np.float32)
+    pure = empty.copy()
+    pure[-1] = 1
+    counts = [ np.all(flat == f, axis=1).sum() for f in (empty, pure) ]
+    return (empty, pure)[int(np.argmax(counts))]
+
+
+class SparsePV(object):
+    """
+    A PV map held in sparse form. Use load() or from_dense() to create.
+
+    Attributes:
+        shape: spatial shape of the grid (X, Y, Z)
+        affine: vox2world matrix
+        fill: value of all voxels that are not stored
+        indices: sorted flat voxel indices of the stored voxels
+    """
+
+    def __init__(self, shape, affine, fill, indices, chunks):
+        self.shape = tuple(int(s) for s in shape)
+        self.affine = np.asarray(affine)
+        self.fill = np.asarray(fill, dtype=np.float32)
+        self.indices = indices
+        self._chunks = chunks
+        self._starts = np.cumsum([0] + [ c.shape[0] for c in chunks ])
+
+    @classmethod
+    def from_dense(cls, data, affine, fill=None):
+        """Sparse form of a dense array sized (X, Y, Z, N)"""
+
+        flat = np.asarray(data, dtype=np.float32).reshape(-1, data.shape[-1])
+        fill = _choose_fill(flat) if fill is None else np.asarray(fill, np.float32)
+        indices = np.flatnonzero(np.any(flat != fill, axis=1))
+        values = flat[indices,:]
+        chunks = [ values[c:c+CHUNK] for c in range(0, max(1, values.shape[0]), CHUNK) ]
+        return cls(data.shape[0:3], affine, fill, indices, chunks)
+
+    @property
+    def n_vox(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nnz(self):
+        return int(self.indices.size)
+
+    @property
+    def values(self):
+        """PVs of all stored voxels (reads every chunk)"""
+        return np.concatenate(self._chunks, axis=0)
+
+    def sum(self):
+        """Total PV of each class over the whole grid"""
+
+        total = sum( c.sum(0, dtype=np.float64) for c in self._chunks )
+        return total + self.fill * (self.n_vox - self.nnz)
+
+    def take(self, idx):
+        """PVs at the given flat voxel indices (fill where not stored)"""
+
+        idx = np.asanyarray(idx)
+        out = np.tile(self.fill, (idx.size, 1))
+        if not self.nnz:
+            return out
+
+        pos = np.minimum(np.searchsorted(self.indices, idx), self.nnz - 1)
+        found = (self.indices[pos] == idx)
+        pos = pos[found]
+        rows = np.flatnonzero(found)
+
+        # Read only from the chunks that are needed
+        which = np.searchsorted(self._starts, pos, side='right') - 1
+        for c in np.unique(which):
+            sel = (which == c)
+            out[rows[sel]] = self._chunks[c][pos[sel] - self._starts[c]]
+        return out
+
+    def flat_dense(self):
+        """Dense view sized (voxels x N), as per reshape(-1, N)"""
+
+        out = np.tile(self.fill, (self.n_vox, 1))
+        for c, start in zip(self._chunks, self._starts):
+            out[self.indices[start:start+c.shape[0]]] = c
+        return out
+
+    def dense(self):
+        """Dense view sized (X, Y, Z, N)"""
+        return self.flat_dense().reshape(*self.shape, -1)
+
+
+def save(path, pv):
+    """Write a SparsePV to a directory at path (replacing any existing)"""
+
+    tmp = path + '.%d.tmp' % os.getpid()
+    os.makedirs(tmp, exist_ok=True)
+
+    np.save(op.join(tmp, 'indices.npy'), np.asarray(pv.indices, dtype=np.int64))
+    chunks = []
+    for i, (c, start) in enumerate(zip(pv._chunks, pv._starts)):
+        name = 'values_%04d.npy' % i
+        np.save(op.join(tmp, name), np.asarray(c, dtype=np.float32))
+        chunks.append({ 'file': name, 'start': int(start),
+            'stop': int(start + c.shape[0]) })
+
+    index = {
+        'format': FORMAT, 'version': VERSION,
+        'shape': list(pv.shape), 'affine': pv.affine.tolist(),
+        'fill': pv.fill.tolist(), 'nnz': pv.nnz, 'chunks': chunks,
+    }
+    with open(op.join(tmp, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    if op.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def load(path, dense=False):
+    """
+    Load a PV map saved by save() (or convert()). If dense, return a dense
+    array sized (X, Y, Z, N), otherwise a SparsePV. NIfTI paths are also
+    accepted, and converted to sparse form in memory if need be.
+    """
+
+    if not op.isdir(path):
+        img = nibabel.load(path)
+        data = img.get_fdata(dtype=np.float32)
+        return data if dense else SparsePV.from_dense(data, img.affine)
+
+    with open(op.join(path, 'index.json'), 'r') as f:
+        index = json.load(f)
+    if index.get('format') != FORMAT:
+        raise RuntimeError("%s is not a sparse PV map" % path)
+
+    indices = np.load(op.join(path, 'indices.npy'), mmap_mode='r')
+    chunks = [ np.load(op.join(path, c['file']), mmap_mode='r')
+        for c in index['chunks'] ]
+    pv = SparsePV(index['shape'], index['affine'], index['fill'], indices, chunks)
+    return pv.dense() if dense else pv
+
+
+def convert(src, path):
+    """Save the NIfTI PV map at src in sparse form at path"""
+    save(path, load(src))
+
+
+def sparse_name(path):
+    """Name of the sparse copy of a NIfTI, eg x.nii.gz -> x.spv"""
+
+    for ext in ('.nii.gz', '.nii'):
+        if path.endswith(ext):
+            return path[:-len(ext)] + '.spv'
+    return path + '.spv'
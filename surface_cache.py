@@ -0,0 +1,87 @@
+# Cache of parsed surface meshes. Parsing a GIFTI surface (XML, base64 and
+# gzip) is slow relative to using it, and the same native surfaces are read
+# by the RC method (at every voxel size) and by run_HCP's cost model. Here,
+# each surface is parsed once to a pair of .npy files (vertices as float64,
+# triangles as int64), keyed by the SHA-256 of the source file, and
+# thereafter memory-mapped read-only. Later loads, in any process, then
+# skip parsing and read from the page cache; the arrays themselves are
+# only shared for as long as the caller does not copy them (rc_method, for
+# one, transforms the vertices into a new array). As the key is the content
+# hash, an edited or replaced surface is simply parsed afresh. Entries are
+# small (a few MB) so are not evicted.
+#
+# Toblerone loads its surfaces itself, and does not use this cache.
+
+import os
+import os.path as op
+
+import nibabel
+import numpy as np
+
+from manifest import file_hash
+
+# May be overridden via the environment, or set directly on the module
+CACHE_DIR = os.environ.get('SURFACE_CACHE_DIR',
+    op.join(op.expanduser('~'), '.cache', 'surface_cache'))
+
+# Part of every key, and increased whenever parse() changes what it returns,
+# so that entries parsed the old way are not used (2: c_ras applied)
+PARSER = 2
+
+
+def cache_paths(path, cache_dir=None):
+    base = op.join(cache_dir or CACHE_DIR, '%s.%d' % (file_hash(path), PARSER))
+    return base + '.points.npy', base + '.tris.npy'
+
+
+def parse(path):
+    """
+    Vertices and triangles of a GIFTI or FreeSurfer surface. FreeSurfer 
+    vertices are shifted by the c_ras in the file's metadata (if any), 
+    into scanner coordinates, as Toblerone does.
+    """
+
+    if path.endswith('.gii'):
+        points, tris = nibabel.load(path).agg_data(('pointset', 'triangle'))
+    else:
+        points, tris, meta = nibabel.freesurfer.read_geometry(path, read_metadata=True)
+        if 'cras' in meta:
+            points = points + meta['cras']
+    return np.asarray(points, dtype=np.float64), np.asarray(tris, dtype=np.int64)
+
+
+def load(path, cache_dir=None):
+    """
+    Vertices and triangles of a surface, as read-only arrays memory-mapped
+    from the cache. The surface is parsed and added on first use.
+    """
+
+    cache_dir = cache_dir or CACHE_DIR
+    ppath, tpath = cache_paths(path, cache_dir)
+
+    # Triangles are written last, so if they exist, so do the points
+    if op.isfile(tpath):
+        return np.load(ppath, mmap_mode='r'), np.load(tpath, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    points, tris = parse(path)
+
+    # Write under temporary names so that other processes never map a
+    # partially written file
+    for data, cpath in ((points, ppath), (tris, tpath)):
+        tmp = cpath + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, cpath)
+
+    return np.load(ppath, mmap_mode='r'), np.load(tpath, mmap_mode='r')
+
+
+def clear(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    for d in os.scandir(cache_dir):
+        if d.name.endswith('.npy'):
+            try:
+                os.remove(d.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,230 @@
+# Lightweight per-task telemetry for the subject pipeline. Wrapping a stage
+# function with traced() (or a block of code with span()) records, for each
+# call: start and end times, the worker PID, peak RSS, bytes read and
+# written (including by reaped subprocesses, eg FAST, FIRST, wb_command) and
+# the CPU time of subprocesses. Records are appended as JSON lines to one
+# file per worker process (and host) within the telemetry directory, so that nothing
+# needs to be gathered from the pool. Afterwards, chrome_trace() writes
+# these out as a Chrome/Perfetto trace (one process per host and one lane
+# per worker, with nested spans) and summary() tabulates them by stage.
+#
+# Telemetry is off unless enabled (which sets TELEMETRY_DIR in the
+# environment, so that it is inherited by worker processes).
+
+import contextlib
+import glob
+import json
+import os
+import os.path as op
+import resource
+import socket
+import threading
+import time
+
+ENV_VAR = 'TELEMETRY_DIR'
+
+# Seconds between RSS samples while a span is open
+SAMPLE_INTERVAL = 0.5
+
+
+def enable(directory):
+    os.makedirs(directory, exist_ok=True)
+    os.environ[ENV_VAR] = op.abspath(directory)
+
+
+def disable():
+    os.environ.pop(ENV_VAR, None)
+
+
+def directory():
+    return os.environ.get(ENV_VAR)
+
+
+def _rss():
+    # Current resident set size in bytes
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _io():
+    # Bytes passed through read/write syscalls, including reaped children
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(l.split(':') for l in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+
+class _PeakSampler(threading.Thread):
+    """Polls this process's RSS in the background, keeping the maximum"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = _rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _rss())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, _rss())
+        return self.peak
+
+
+def _write(record):
+    d = directory()
+    path = op.join(d, 'events_%s_%d.jsonl' % (socket.gethostname(), os.getpid()))
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextlib.contextmanager
+def span(name, stage=None, **args):
+    """
+    Record the block within as one event. Does nothing unless telemetry is
+    enabled. Extra keyword args (eg, vox=v) are stored with the event.
+    """
+
+    if not directory():
+        yield
+        return
+
+    sampler = _PeakSampler()
+    sampler.start()
+    rd0, wr0 = _io()
+    ch0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    error = None
+
+    try:
+        yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+
+    finally:
+        end = time.time()
+        rd1, wr1 = _io()
+        ch1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        peak = sampler.stop()
+
+        cpu = lambda r: r.ru_utime + r.ru_stime
+        record = {
+            'name': name, 'stage': stage or name, 'args': args,
+            'host': socket.gethostname(), 'pid': os.getpid(),
+            'start': start, 'end': end,
+            'cpu': cpu(self1) - cpu(self0),
+            'subprocess_cpu': cpu(ch1) - cpu(ch0),
+            'rss_peak': peak,
+            # ru_maxrss (kB) is the largest of any reaped child so far, so
+            # is only meaningful for this span if it grew during it
+            'child_rss_peak': (ch1.ru_maxrss * 1024 if ch1.ru_maxrss > ch0.ru_maxrss else 0),
+            'read_bytes': rd1 - rd0, 'write_bytes': wr1 - wr0,
+            'error': error,
+        }
+        _write(record)
+
+
+class traced(object):
+    """
+    Wrap a per-subject stage function (eg, fast_subject) so that each call
+    is recorded as a span, named by the stage and its arguments. The
+    wrapper can be pickled, for use with multiprocessing and the scheduler.
+    """
+
+    def __init__(self, func, stage=None):
+        self.func = func
+        self.stage = stage or func.__name__
+        self.__name__ = self.stage
+
+    def __call__(self, *args):
+        label = ' '.join(op.basename(str(a)) for a in args)
+        with span('%s %s' % (self.stage, label), stage=self.stage,
+                  call=[ str(a) for a in args ]):
+            return self.func(*args)
+
+
+def load_events(directory):
+    events = []
+    for path in sorted(glob.glob(op.join(directory, 'events_*.jsonl'))):
+        with open(path, 'r') as f:
+            events.extend( json.loads(l) for l in f if l.strip() )
+    return sorted(events, key=lambda e: e['start'])
+
+
+def chrome_trace(directory, outname):
+    """
+    Write all events in directory as a Chrome trace (JSON), viewable in
+    chrome://tracing or ui.perfetto.dev. Each host is a trace process, and
+    each worker process on it a lane, so that workers on different nodes
+    with the same PID are kept apart.
+    """
+
+    events = load_events(directory)
+    t0 = min(( e['start'] for e in events ), default=0)
+    hosts = sorted({ e.get('host', '') for e in events })
+    hidx = { h: i for i, h in enumerate(hosts) }
+    trace = []
+    for e in events:
+        pid = hidx[e.get('host', '')]
+        args = dict(e['args'])
+        args.update({ k: e[k] for k in ('cpu', 'subprocess_cpu', 'read_bytes',
+            'write_bytes', 'error') })
+        args['rss_peak_mb'] = e['rss_peak'] / 2**20
+        args['child_rss_peak_mb'] = e['child_rss_peak'] / 2**20
+        trace.append({ 'name': e['name'], 'cat': e['stage'], 'ph': 'X',
+            'ts': (e['start'] - t0) * 1e6, 'dur': (e['end'] - e['start']) * 1e6,
+            'pid': pid, 'tid': e['pid'], 'args': args })
+
+        # RSS as a counter track, so memory peaks line up with the spans
+        trace.append({ 'name': 'rss_mb', 'ph': 'C', 'pid': pid, 'tid': e['pid'],
+            'ts': (e['end'] - t0) * 1e6, 'args': { str(e['pid']): args['rss_peak_mb'] } })
+
+    for host, pid in sorted({ (e.get('host', ''), e['pid']) for e in events }):
+        trace.append({ 'name': 'thread_name', 'ph': 'M', 'pid': hidx[host], 'tid': pid,
+            'args': { 'name': 'worker %d' % pid } })
+    for host, i in hidx.items():
+        trace.append({ 'name': 'process_name', 'ph': 'M', 'pid': i,
+            'args': { 'name': host or 'unknown host' } })
+
+    with open(outname, 'w') as f:
+        json.dump({ 'traceEvents': trace, 'displayTimeUnit': 'ms' }, f)
+
+
+def summary(directory, top=10):
+    """
+    Summary table of events by stage (count, total and max wall time, the
+    slowest call, peak RSS, IO and subprocess CPU), followed by the slowest
+    individual calls. Returns the table as a string.
+    """
+
+    events = load_events(directory)
+    wall = lambda e: e['end'] - e['start']
+    lines = ['%-12s %5s %10s %10s %10s %9s %9s %9s %10s  %s' % ('stage', 'n',
+        'total(s)', 'mean(s)', 'max(s)', 'rss(MB)', 'read(MB)', 'write(MB)',
+        'subproc(s)', 'slowest')]
+
+    for stage in sorted({ e['stage'] for e in events }):
+        es = [ e for e in events if e['stage'] == stage ]
+        slowest = max(es, key=wall)
+        total = sum( wall(e) for e in es )
+        lines.append('%-12s %5d %10.1f %10.1f %10.1f %9.0f %9.0f %9.0f %10.1f  %s' % (
+            stage, len(es), total, total / len(es), wall(slowest),
+            max( max(e['rss_peak'], e['child_rss_peak']) for e in es ) / 2**20,
+            sum( e['read_bytes'] for e in es ) / 2**20,
+            sum( e['write_bytes'] for e in es ) / 2**20,
+            sum( e['subprocess_cpu'] for e in es ), slowest['name']))
+
+    lines.append('')
+    lines.append('Slowest calls:')
+    for e in sorted(events, key=wall, reverse=True)[:top]:
+        lines.append('  %8.1fs  pid %-7d %s%s' % (wall(e), e['pid'], e['name'],
+            ' (FAILED)' if e['error'] else ''))
+
+    return '\n'.join(lines)
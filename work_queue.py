@@ -0,0 +1,359 @@
+# A work queue kept on a shared filesystem, so that workers on any number of
+# nodes mounting the same data directory can share out the per-subject
+# tasks. Everything is plain files, written atomically, in one directory:
+#
+#   tasks/<name>.json    the task: stage, args, cores needed, dependencies
+#   leases/<name>        held by the worker running the task, and refreshed
+#                        by its heartbeat; an expired lease may be taken over
+#   done/<name>          written once the task has completed
+#   failed/<name>.json   number of failed attempts and the last error
+#
+# Every change to a lease (claim, heartbeat, release) is made while holding
+# an fcntl lock on leases/<name>.lock, and the lease is read back afterwards
+# to check it is still ours, so only one worker can hold a task. A task
+# whose worker has crashed, or whose node has gone down, is picked up again
+# once its lease expires. As all state is on disk, the queue can be filled
+# again, or workers restarted, at any time.
+#
+# Each task runs in its own process group, which is killed if its worker
+# exits or dies, so that no task carries on unleased (and is then run twice).
+#
+# Lease expiry is judged by each node's clock, so clocks should be roughly
+# in sync relative to LEASE. The filesystem must support fcntl locks across
+# nodes (as NFS does, via lockd).
+
+import contextlib
+import ctypes
+import fcntl
+import json
+import os
+import os.path as op
+import signal
+import socket
+import sys
+import time
+import traceback
+import multiprocessing
+
+# Seconds a lease lasts without a heartbeat, and between heartbeats
+LEASE = 300
+HEARTBEAT = 30
+
+# Seconds between polls for claimable tasks when none are ready
+POLL = 10
+
+# Attempts at a task (that raised an error) before it is given up on
+MAX_ATTEMPTS = 2
+
+# From linux/prctl.h
+PR_SET_PDEATHSIG = 1
+
+
+def _write_json(path, obj):
+    tmp = op.join(op.dirname(path), '.%s.%d.tmp' % (op.basename(path), os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def worker_id():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """
+    A queue of named tasks within directory (created if need be). Task
+    names must be valid filenames.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for d in ('tasks', 'leases', 'done', 'failed'):
+            os.makedirs(op.join(directory, d), exist_ok=True)
+
+    def _path(self, kind, name):
+        ext = '.json' if kind in ('tasks', 'failed') else ''
+        return op.join(self.directory, kind, name + ext)
+
+    def add(self, name, stage, args=(), cpus=1, deps=(), priority=0):
+        """
+        Add a task, unless it is already queued (or done). Ready tasks are
+        claimed in order of priority (lowest first).
+        """
+
+        path = self._path('tasks', name)
+        if not op.isfile(path):
+            _write_json(path, { 'name': name, 'stage': stage, 'args': list(args),
+                'cpus': cpus, 'deps': list(deps), 'priority': priority })
+
+    def tasks(self):
+        """All tasks, in priority order"""
+
+        names = [ f[:-5] for f in os.listdir(op.join(self.directory, 'tasks'))
+            if f.endswith('.json') ]
+        tasks = [ t for t in map(self.task, names) if t is not None ]
+        return sorted(tasks, key=lambda t: (t['priority'], t['name']))
+
+    def task(self, name):
+        return _read_json(self._path('tasks', name))
+
+    def is_done(self, name):
+        return op.isfile(self._path('done', name))
+
+    def attempts(self, name):
+        f = _read_json(self._path('failed', name))
+        return f['attempts'] if f else 0
+
+    def lease(self, name):
+        return _read_json(self._path('leases', name))
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        # Held while reading and changing a task's lease
+        with open(self._path('leases', name) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def state(self, name):
+        """One of done, failed (given up on), running or pending"""
+
+        if self.is_done(name):
+            return 'done'
+        if self.attempts(name) >= MAX_ATTEMPTS:
+            return 'failed'
+        lease = self.lease(name)
+        if lease is not None and lease['expires'] > time.time():
+            return 'running'
+        return 'pending'
+
+    def claim(self, name, worker, lease=LEASE):
+        """Try to take the lease on a task. Returns True on success."""
+
+        with self._locked(name):
+            current = self.lease(name)
+            if current is not None and current['expires'] > time.time():
+                return False
+            _write_json(self._path('leases', name), { 'worker': worker,
+                'expires': time.time() + lease, 'claimed': time.time() })
+            if not self._holds(name, worker):
+                return False
+
+        # Another worker may have completed it between our checks
+        if self.is_done(name):
+            self.release(name, worker)
+            return False
+        return True
+
+    def heartbeat(self, name, worker, lease=LEASE):
+        """Extend a lease. Returns False if the lease is no longer ours."""
+
+        with self._locked(name):
+            current = self.lease(name)
+            if current is None or current['worker'] != worker:
+                return False
+            current['expires'] = time.time() + lease
+            _write_json(self._path('leases', name), current)
+            return self._holds(name, worker)
+
+    def _holds(self, name, worker):
+        current = self.lease(name)
+        return current is not None and current['worker'] == worker
+
+    def release(self, name, worker):
+        with self._locked(name):
+            if self._holds(name, worker):
+                try:
+                    os.remove(self._path('leases', name))
+                except FileNotFoundError:
+                    pass
+
+    def complete(self, name, worker, info=None):
+        _write_json(self._path('done', name), dict(info or {}, worker=worker,
+            finished=time.time()))
+        self.release(name, worker)
+
+    def fail(self, name, worker, error):
+        _write_json(self._path('failed', name), { 'attempts': self.attempts(name) + 1,
+            'error': error, 'worker': worker })
+        self.release(name, worker)
+
+    def ready(self):
+        """Pending tasks whose dependencies are all done, in priority order"""
+
+        tasks = self.tasks()
+        done = { t['name'] for t in tasks if self.is_done(t['name']) }
+        return [ t for t in tasks if (t['name'] not in done)
+            and self.state(t['name']) == 'pending'
+            and all(d in done for d in t['deps']) ]
+
+    def progress(self):
+        """
+        Counts of tasks in each state, overall and by stage. Tasks that
+        depend on a failed task are counted as blocked.
+        """
+
+        tasks = self.tasks()
+        states = { t['name']: self.state(t['name']) for t in tasks }
+
+        # Propagate failures downstream
+        changed = True
+        while changed:
+            changed = False
+            for t in tasks:
+                if states[t['name']] == 'pending' and any(
+                        states.get(d) in ('failed', 'blocked') for d in t['deps']):
+                    states[t['name']] = 'blocked'
+                    changed = True
+
+        out = { 'total': {} }
+        for t in tasks:
+            s = states[t['name']]
+            out['total'][s] = out['total'].get(s, 0) + 1
+            stage = out.setdefault(t['stage'], {})
+            stage[s] = stage.get(s, 0) + 1
+        return out
+
+    def finished(self):
+        """True once no task is pending or running (blocked ones aside)"""
+
+        return not any( k in ('pending', 'running')
+            for k in self.progress()['total'] )
+
+
+def _kill_group(*args):
+    # SIGTERM handler of a task: kill its whole group. Processes it forks
+    # (eg, a Pool's workers) inherit this, but are simply terminated
+    if os.getpgid(0) != os.getpid():
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+    os.killpg(0, signal.SIGKILL)
+
+
+def _child(func, args, errpath, parent):
+    # Run one task in its own process group, which is killed (including any
+    # processes the task starts) if the worker dies. Write any traceback for
+    # the parent
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, _kill_group)
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        pass
+    if os.getppid() != parent:
+        _kill_group()
+
+    try:
+        func(*args)
+    except BaseException:
+        with open(errpath, 'w') as f:
+            f.write(traceback.format_exc())
+        raise
+
+
+def _kill(p):
+    # Kill a task's process group (or just the process, if it has not yet
+    # made its own group)
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        p.kill()
+    p.join()
+
+
+def _exit(*args):
+    sys.exit(1)
+
+
+def run_worker(queue, stages, budget=None, lease=LEASE, heartbeat=HEARTBEAT, poll=POLL):
+    """
+    Claim and run tasks from a queue until none are left to do, running as
+    many at once as fit within this node's CPU budget. Ready tasks are
+    started in priority order, and none ahead of one that is waiting for
+    cores (as scheduler.run_tasks). Each task runs in its own process while
+    this one keeps its lease alive; if this worker exits, or is terminated,
+    its tasks are killed and their leases released.
+
+    Args:
+        queue: WorkQueue
+        stages: dict of stage name -> function, called as func(*args)
+        budget: cores available on this node (default all)
+    """
+
+    budget = budget or os.cpu_count()
+    worker = worker_id()
+    running = {}
+    signal.signal(signal.SIGTERM, _exit)
+
+    try:
+        _worker_loop(queue, stages, budget, lease, heartbeat, poll, worker, running)
+    finally:
+        for name, (p, need, errpath) in running.items():
+            print('%s: killing %s' % (worker, name))
+            _kill(p)
+            queue.release(name, worker)
+
+
+def _worker_loop(queue, stages, budget, lease, heartbeat, poll, worker, running):
+
+    free = budget
+    last_beat = time.time()
+
+    while True:
+
+        # Start ready tasks in order while they fit, stopping at the first
+        # that does not (no backfilling)
+        for t in queue.ready():
+            need = min(t['cpus'], budget)
+            if need > free:
+                break
+            if not queue.claim(t['name'], worker, lease):
+                continue
+            errpath = op.join(queue.directory, 'leases', '.%s.err' % t['name'])
+            p = multiprocessing.Process(target=_child,
+                args=(stages[t['stage']], t['args'], errpath, os.getpid()))
+            p.start()
+            running[t['name']] = (p, need, errpath)
+            free -= need
+            print('%s: started %s' % (worker, t['name']))
+
+        # Reap finished tasks
+        for name, (p, need, errpath) in list(running.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            if p.exitcode == 0:
+                queue.complete(name, worker)
+                print('%s: completed %s' % (worker, name))
+            else:
+                err = 'exit code %s' % p.exitcode
+                if op.isfile(errpath):
+                    with open(errpath, 'r') as f:
+                        err = f.read()
+                    os.remove(errpath)
+                queue.fail(name, worker, err)
+                print('%s: task %s failed: %s' % (worker, name, err.strip().splitlines()[-1]))
+            free += need
+            del running[name]
+
+        # Keep our leases alive, abandoning any task that has been taken
+        # over by another worker (eg, after this node stalled)
+        if time.time() - last_beat > heartbeat:
+            for name, (p, need, errpath) in list(running.items()):
+                if not queue.heartbeat(name, worker, lease):
+                    print('%s: lost lease on %s' % (worker, name))
+                    _kill(p)
+                    free += need
+                    del running[name]
+            last_beat = time.time()
+
+        if not running and queue.finished():
+            break
+        time.sleep(min(poll, heartbeat) if (running or not queue.ready()) else 0)